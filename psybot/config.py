@@ -32,9 +32,18 @@ class Config:
         self.guild_id = parse_variable("GUILD_ID", int)
         self.mongodb_uri = parse_variable("MONGODB_URI", str, default="mongodb://localhost:27017")
         self.mongodb_db = parse_variable("MONGODB_DB", str, default="psybot")
+        self.db_workers = parse_variable("DB_WORKERS", int, default=8)
+        self.settings_cache_ttl = parse_variable("SETTINGS_CACHE_TTL", int, default=0)
         self.backups_dir = parse_variable("BACKUPS_DIR", str, default=BACKUPS_DIR_DEFAULT)
         self.disable_download = parse_variable("DISABLE_DOWNLOAD", bool, default=False)
+        self.export_concurrency = parse_variable("EXPORT_CONCURRENCY", int, default=4)
+        self.download_workers = parse_variable("DOWNLOAD_WORKERS", int, default=4)
+        self.export_edit_window = parse_variable("EXPORT_EDIT_WINDOW_HOURS", int, default=24)
+        self.archive_exports = parse_variable("ARCHIVE_EXPORTS", bool, default=False)
+        self.reexport_webhooks = parse_variable("REEXPORT_WEBHOOKS", int, default=4)
         self.ctftime_url = parse_variable("CTFTIME_URL", str, default="https://ctftime.org")
+        self.ctftime_cache_ttl = parse_variable("CTFTIME_CACHE_TTL", int, default=600)
+        self.work_message_delay = parse_variable("WORK_MESSAGE_DELAY_MS", int, default=1500) / 1000
 
 
 config = Config()
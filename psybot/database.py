@@ -1,6 +1,19 @@
-from psybot.config import config
+import asyncio
+import functools
 
+from concurrent.futures import ThreadPoolExecutor
 from mongoengine import connect
 
-client = connect(db=config.mongodb_db, host=config.mongodb_uri)
+from psybot.config import config
+
+client = connect(db=config.mongodb_db, host=config.mongodb_uri, maxPoolSize=config.db_workers)
 db = client[config.mongodb_db]
+
+# MongoEngine is synchronous, so all queries are run on a dedicated thread pool
+# instead of blocking the event loop. It is sized to match the connection pool.
+_executor = ThreadPoolExecutor(max_workers=config.db_workers, thread_name_prefix="psybot-db")
+
+
+async def run_db(func, /, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
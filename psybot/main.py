@@ -5,10 +5,10 @@ import discord
 
 from discord import app_commands
 
-from psybot.modules import ctf, ctftime, challenge, notes, psybot
+from psybot.modules import archive, ctf, ctftime, challenge, notes, psybot
 from psybot.config import config
-from psybot.database import db
-from psybot.utils import setup_settings
+from psybot import repository
+from psybot.utils import setup_settings, track_channel, untrack_channel, load_category_capacity
 
 logging.basicConfig(level=logging.INFO)
 
@@ -18,6 +18,7 @@ client = discord.Client(intents=intents)
 tree = app_commands.CommandTree(client)
 
 guild_obj = discord.Object(id=config.guild_id) if config.guild_id else None
+archive.add_commands(tree, guild_obj)
 challenge.add_commands(tree, guild_obj)
 ctf.add_commands(tree, guild_obj)
 ctftime.add_commands(tree, guild_obj)
@@ -37,18 +38,22 @@ async def setup_hook():
 @client.event
 async def on_ready():
     try:
-        db.command("ping")
+        await repository.ping()
     except pymongo.errors.ServerSelectionTimeoutError:
         logging.critical("Could not connect to MongoDB")
         exit(1)
+    await repository.ensure_indexes()
+    await repository.warm_channel_index()
     if config.guild_id:
         guild = client.get_guild(config.guild_id)
         if guild:
             await setup_settings(guild)
+            await load_category_capacity(guild)
             await tree.sync(guild=guild_obj)
     else:
         for guild in client.guilds:
             await setup_settings(guild)
+            await load_category_capacity(guild)
         await tree.sync()
     activity = discord.Activity(name="CTF", type=discord.ActivityType.playing)
     await client.change_presence(activity=activity)
@@ -60,10 +65,27 @@ async def on_guild_join(guild: discord.Guild):
     if config.guild_id is None or config.guild_id == guild.id:
         logging.info(f"{client.user.name} has joined guild \"{guild.name}\"")
         await setup_settings(guild)
+        await load_category_capacity(guild)
         if config.guild_id:
             await tree.sync(guild=guild_obj)
 
 
+@client.event
+async def on_guild_channel_create(channel: discord.abc.GuildChannel):
+    track_channel(channel)
+
+
+@client.event
+async def on_guild_channel_update(_before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+    track_channel(after)
+
+
+@client.event
+async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
+    repository.channel_index.discard(channel.id)
+    untrack_channel(channel)
+
+
 @tree.error
 async def on_app_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
     async def send_response(message):
@@ -89,7 +111,10 @@ async def on_app_command_error(interaction: discord.Interaction, error: app_comm
 
 async def main():
     async with client:
-        await client.start(config.bot_token)
+        try:
+            await client.start(config.bot_token)
+        finally:
+            await ctftime.ctftime_http.close()
 
 
 if __name__ == '__main__':
@@ -11,6 +11,6 @@ class BackupCategory(Document):
                 'fields': ['category_id'],
                 'unique': True
             },
-            'original_id'
+            ('original_id', 'index')
         ]
     }
\ No newline at end of file
@@ -22,6 +22,8 @@ class Challenge(Document):
             {
                 'fields': ['channel_id'],
                 'unique': True
-            }
+            },
+            ('ctf', 'solved'),
+            ('ctf', 'name', 'category')
         ]
     }
@@ -10,6 +10,7 @@ class CtfCategory(Document):
             {
                 'fields': ['name', 'guild_id'],
                 'unique': True
-            }
+            },
+            ('guild_id', '-count')
         ]
     }
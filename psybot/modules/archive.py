@@ -0,0 +1,37 @@
+import asyncio
+import discord
+
+from pathlib import Path
+from dateutil import parser as dateutil_parser
+from discord import app_commands
+
+from psybot.config import config
+from psybot.modules.export import search_exports
+from psybot.utils import get_team_role
+
+
+class Archive(app_commands.Group):
+
+    @app_commands.command(description="Search the messages of exported CTFs")
+    @app_commands.describe(query="Words to search for. End a word with * to match anything starting with it",
+                           ctf="Only search this CTF", author="Only search messages by this nickname or username")
+    @app_commands.guild_only
+    async def search(self, interaction: discord.Interaction, query: str, ctf: str | None = None, author: str | None = None):
+        if await get_team_role(interaction.guild) not in interaction.user.roles:
+            raise app_commands.AppCommandError("Only team members are allowed to search exported CTFs")
+
+        guild_dir = Path(config.backups_dir) / str(interaction.guild_id)
+        hits = await asyncio.to_thread(search_exports, guild_dir, query, ctf, author)
+        if not hits:
+            raise app_commands.AppCommandError("No messages found")
+
+        embed = discord.Embed(title=f"Results for \"{query}\""[:256])
+        for hit in hits:
+            timestamp = int(dateutil_parser.parse(hit["created_at"]).timestamp())
+            embed.add_field(name=f"{hit['ctf']} #{hit['channel']}"[:256],
+                            value=f"**{hit['author']}** <t:{timestamp}:d>\n{hit['snippet']}"[:1024], inline=False)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+
+def add_commands(tree: app_commands.CommandTree, guild: discord.Object | None):
+    tree.add_command(Archive(), guild=guild)
@@ -1,4 +1,5 @@
 import re
+import asyncio
 import tempfile
 import discord
 import matplotlib.pyplot as plt
@@ -8,17 +9,18 @@ from mongoengine import NotUniqueError
 from matplotlib.table import Table, Cell
 from pathlib import Path
 
-from psybot.models.ctf_category import CtfCategory
+from psybot import repository
 from psybot.utils import move_channel, is_team_admin, get_incomplete_category, create_channel, get_complete_category, \
     get_admin_role, sanitize_channel_name, get_settings, MAX_CHANNELS
 from psybot.modules.ctf import get_ctf_db
+from psybot.config import config
 
 from psybot.models.challenge import Challenge
 from psybot.models.ctf import Ctf
 
 
 async def check_challenge(channel: discord.TextChannel) -> tuple[Challenge | None, Ctf | None]:
-    chall_db: Challenge = Challenge.objects(channel_id=channel.id).first()
+    chall_db: Challenge = await repository.get_challenge(channel.id)
     if chall_db is None:
         raise app_commands.AppCommandError("Not a challenge!")
     ctf_db: Ctf = chall_db.ctf
@@ -29,8 +31,8 @@ async def check_challenge(channel: discord.TextChannel) -> tuple[Challenge | Non
 
 async def category_autocomplete(interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
     current = sanitize_channel_name(current)
-    query = CtfCategory.objects(name=re.compile("^" + re.escape(current)), guild_id=interaction.guild_id).order_by('-count')[:25]
-    return [app_commands.Choice(name=c["name"], value=c["name"]) for c in query]
+    names = await repository.find_categories(interaction.guild_id, current, limit=25)
+    return [app_commands.Choice(name=name, value=name) for name in names]
 
 
 async def category_autocomplete_nullable(interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
@@ -48,8 +50,34 @@ def get_work_embeds(chall_db: Challenge):
             embeds.append(discord.Embed(color=w.color).add_field(name=w.name, value=", ".join(f"<@!{work.user}>" for work in work_list)))
     return embeds
 
-async def update_work_message(chall_db: Challenge, channel: discord.PartialMessageable | None):
-    if channel:
+
+class WorkMessageScheduler:
+    """Coalesces work message edits per channel, so a burst of status changes results in a single edit"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.requested = 0
+        self.edited = 0
+        self._pending: dict[int, tuple[Challenge, discord.TextChannel]] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def saved(self) -> int:
+        return self.requested - self.edited - len(self._pending)
+
+    def schedule(self, chall_db: Challenge, channel: discord.TextChannel):
+        self.requested += 1
+        if chall_db.channel_id not in self._pending:
+            task = asyncio.create_task(self._flush(chall_db.channel_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        self._pending[chall_db.channel_id] = (chall_db, channel)
+
+    async def _flush(self, channel_id: int):
+        await asyncio.sleep(self.delay)
+        chall_db, channel = self._pending.pop(channel_id)
+        self.edited += 1
+        # The embeds are built now, so they reflect every change made during the delay
         message = channel.get_partial_message(chall_db.work_message)
         try:
             await message.edit(embeds=get_work_embeds(chall_db))
@@ -57,30 +85,26 @@ async def update_work_message(chall_db: Challenge, channel: discord.PartialMessa
             pass
 
 
+work_message_scheduler = WorkMessageScheduler(config.work_message_delay)
+
+
+def update_work_message(chall_db: Challenge, channel: discord.TextChannel | None):
+    if channel and chall_db.work_message:
+        work_message_scheduler.schedule(chall_db, channel)
+
+
 async def set_work(guild: discord.Guild, chall_db: Challenge, user: discord.User, value: int):
-    if value == 0:
-        chall_db.working.filter(user=user.id).delete()
-    else:
-        work = chall_db.working.filter(user=user.id).first()
-        if work is None:
-            chall_db.working.create(user=user.id, value=value)
-        elif work.value != value:
-            work.value = value
-        else:
-            return
-    chall_db.save()
+    if not await repository.set_work(chall_db, user.id, value):
+        return
     channel = guild.get_channel(chall_db.channel_id)
-    await update_work_message(chall_db, channel)
+    update_work_message(chall_db, channel)
 
 
 async def move_work(guild: discord.Guild, ctf_db: Ctf, chall_db: Challenge, user: discord.User):
-    for chall in Challenge.objects(ctf=ctf_db):
-        if chall.id == chall_db.id:
-            continue
-        work = chall.working.filter(user=user.id).first()
-        if work is not None and work.value == 1:
-            await set_work(guild, chall, user, 2)
-    await set_work(guild, chall_db, user, 1)
+    demoted, _ = await asyncio.gather(repository.demote_work(ctf_db, user.id, exclude=chall_db),
+                                      set_work(guild, chall_db, user, 1))
+    for chall in demoted:
+        update_work_message(chall, guild.get_channel(chall.channel_id))
 
 
 class WorkView(ui.View):
@@ -101,12 +125,12 @@ async def add(interaction: discord.Interaction, category: str, name: str):
     ctf_db = await get_ctf_db(interaction.channel)
 
     if len(interaction.guild.channels) >= MAX_CHANNELS - 3:
-        admin_role = get_admin_role(interaction.guild)
+        admin_role = await get_admin_role(interaction.guild)
         await interaction.response.send_message(f"There are too many channels on this discord server. Please "
                                                 f"wait for an admin to delete some channels. {admin_role.mention}",
                                                 allowed_mentions=discord.AllowedMentions.all())
         return
-    incomplete_category = get_incomplete_category(interaction.guild)
+    incomplete_category = await get_incomplete_category(interaction.guild)
 
     ctf = sanitize_channel_name(ctf_db.name) or '_'
     name = sanitize_channel_name(name) or '_'
@@ -118,16 +142,16 @@ async def add(interaction: discord.Interaction, category: str, name: str):
         category = None
         fullname = f"{ctf}-{name}"
 
-    settings = get_settings(interaction.guild)
+    settings = await get_settings(interaction.guild)
     if settings.enforce_categories:
-        if category is not None and not CtfCategory.objects(name=category, guild_id=interaction.guild_id):
+        if category is not None and not await repository.category_exists(interaction.guild_id, category):
             raise app_commands.AppCommandError("Invalid CTF category")
 
-    if old_chall := Challenge.objects(name=name, category=category, ctf=ctf_db).first():
+    if old_chall := await repository.find_challenge(ctf_db, name, category):
         if interaction.guild.get_channel(old_chall.channel_id):
             raise app_commands.AppCommandError("A challenge with that name already exists")
         else:
-            old_chall.delete()
+            await repository.delete(old_chall)
 
     new_channel = await create_channel(fullname, interaction.channel.overwrites, incomplete_category)
     work_message_id = None
@@ -137,14 +161,10 @@ async def add(interaction: discord.Interaction, category: str, name: str):
         work_message_id = work_message.id
 
     chall_db = Challenge(name=name, category=category, channel_id=new_channel.id, ctf=ctf_db, work_message=work_message_id)
-    chall_db.save()
+    await repository.save(chall_db)
 
     if category:
-        ctf_category = CtfCategory.objects(name=category, guild_id=interaction.guild_id).first()
-        if ctf_category is None:
-            ctf_category = CtfCategory(name=category, guild_id=interaction.guild_id, count=0)
-        ctf_category.count += 1
-        ctf_category.save()
+        await repository.increment_category(interaction.guild_id, category)
 
     await interaction.response.send_message("Added challenge {}".format(new_channel.mention))
 
@@ -167,9 +187,9 @@ async def done(interaction: discord.Interaction, contributors: str | None):
 
     chall_db.solvers = users
     chall_db.solved = True
-    chall_db.save()
+    await repository.save(chall_db)
 
-    await move_channel(interaction.channel, get_complete_category(interaction.guild))
+    await move_channel(interaction.channel, await get_complete_category(interaction.guild))
 
     msg = ":tada: {} was solved by ".format(interaction.channel.mention) + " ".join(f"<@!{user}>" for user in users) + " !"
     await interaction.guild.get_channel(ctf_db.channel_id).send(msg)
@@ -189,9 +209,9 @@ async def undone(interaction: discord.Interaction):
 
     chall_db.solvers = []
     chall_db.solved = False
-    chall_db.save()
+    await repository.save(chall_db)
 
-    await move_channel(interaction.channel, get_incomplete_category(interaction.guild))
+    await move_channel(interaction.channel, await get_incomplete_category(interaction.guild))
     await interaction.edit_original_response(content="Reopened challenge as not done")
 
 
@@ -204,8 +224,7 @@ class CategoryCommands(app_commands.Group):
         if not category:
             raise app_commands.AppCommandError("Invalid category name")
         try:
-            ctf_category = CtfCategory(name=category, guild_id=interaction.guild_id, count=5)
-            ctf_category.save()
+            await repository.create_category(interaction.guild_id, category, count=5)
         except NotUniqueError:
             await interaction.response.send_message("CTF category already exists", ephemeral=True)
         else:
@@ -216,12 +235,10 @@ class CategoryCommands(app_commands.Group):
     @app_commands.guild_only
     @app_commands.check(is_team_admin)
     async def delete(self, interaction: discord.Interaction, category: str):
-        ctf_category: CtfCategory = CtfCategory.objects(name=category, guild_id=interaction.guild_id).first()
-        if ctf_category is None:
-            await interaction.response.send_message("Unknown CTF category", ephemeral=True)
-        else:
-            ctf_category.delete()
+        if await repository.delete_category(interaction.guild_id, category):
             await interaction.response.send_message("Deleted CTF category", ephemeral=True)
+        else:
+            await interaction.response.send_message("Unknown CTF category", ephemeral=True)
 
 
 class WorkValue:
@@ -312,9 +329,9 @@ class WorkingCommands(app_commands.Group):
 
         await interaction.response.defer(ephemeral=True)
         if filter == 0:
-            challs = Challenge.objects(ctf=ctf_db)
+            challs = await repository.get_challenges(ctf_db)
         else:
-            challs = Challenge.objects(ctf=ctf_db, solved=False)
+            challs = await repository.get_challenges(ctf_db, solved=False)
         sorted_challs = sorted(challs, key=lambda x: (x.category or '', x.name))
 
         # Filter out deleted challs
@@ -323,7 +340,7 @@ class WorkingCommands(app_commands.Group):
             if interaction.guild.get_channel(chall.channel_id):
                 challs.append(chall)
             else:
-                chall.delete()
+                await repository.delete(chall)
 
         # Create table of users who have done work
         tbl = {}
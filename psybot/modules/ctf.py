@@ -1,7 +1,8 @@
-import json
 import re
 import time
+import asyncio
 import logging
+import sqlite3
 import discord
 import aiohttp
 import traceback
@@ -11,8 +12,10 @@ from dateutil import parser as dateutil_parser
 from pathlib import Path
 
 from psybot.utils import *
+from psybot import repository
 from psybot.modules.ctftime import Ctftime
-from psybot.modules.export import export_channels, reexport_ctf
+from psybot.modules.export import export_channels, reexport_ctf, archive_export, find_export, count_planned_messages, \
+    index_export, ARCHIVE_SUFFIX
 from psybot.config import config
 
 from psybot.models.challenge import Challenge
@@ -20,9 +23,9 @@ from psybot.models.ctf import Ctf
 
 
 async def get_ctf_db(channel: discord.TextChannel, archived: bool | None = False, allow_chall: bool = True) -> Ctf:
-    ctf_db: Ctf = Ctf.objects(channel_id=channel.id).first()
+    ctf_db: Ctf = await repository.get_ctf(channel.id)
     if ctf_db is None:
-        chall_db: Challenge = Challenge.objects(channel_id=channel.id).first()
+        chall_db: Challenge = await repository.get_challenge(channel.id)
         if not allow_chall or chall_db is None:
             raise app_commands.AppCommandError("Not a CTF channel!")
         ctf_db: Ctf = chall_db.ctf
@@ -35,7 +38,7 @@ async def get_ctf_db(channel: discord.TextChannel, archived: bool | None = False
 
 async def create_voice_channels(guild: discord.Guild, ctf_name: str, overwrites: dict, settings: GuildSettings) -> list[int]:
     voice_channels = []
-    voice_category = get_voice_category(guild, settings=settings) if settings.per_ctf_voice_channels > 0 else None
+    voice_category = await get_voice_category(guild, settings=settings) if settings.per_ctf_voice_channels > 0 else None
 
     # Remove send_message permissions. We don't want more work when archiving
     overwrites = overwrites.copy()
@@ -95,7 +98,7 @@ class RequestButton(ui.DynamicItem[ui.Button], template=r'invite_request:ctf:(?P
     async def callback(self, interaction: discord.Interaction) -> None:
         try:
             ctf_channel = interaction.guild.get_channel(self.ctf_id)
-            settings = get_settings(interaction.guild)
+            settings = await get_settings(interaction.guild)
 
             if ctf_channel is None:
                 raise app_commands.AppCommandError("The invite is invalid")
@@ -181,7 +184,7 @@ class CtfCommands(app_commands.Group):
     @app_commands.guild_only
     @app_commands.check(is_team_admin)
     async def create(self, interaction: discord.Interaction, name: str, ctftime: str | None, private: bool = False):
-        settings = get_settings(interaction.guild)
+        settings = await get_settings(interaction.guild)
 
         if len(interaction.guild.channels) >= MAX_CHANNELS - 2 - max(0, settings.per_ctf_voice_channels):
             raise app_commands.AppCommandError("There are too many channels on this discord server")
@@ -191,7 +194,7 @@ class CtfCommands(app_commands.Group):
 
         await interaction.response.defer()
 
-        ctf_category = get_ctfs_category(interaction.guild, settings=settings)
+        ctf_category = await get_ctfs_category(interaction.guild, settings=settings)
 
         new_role = await interaction.guild.create_role(name=f"{name}-team")
         overwrites = {
@@ -199,7 +202,7 @@ class CtfCommands(app_commands.Group):
             new_role: discord.PermissionOverwrite(view_channel=True, read_message_history=True, send_messages=True)
         }
         if not private and settings.use_team_role_as_acl:
-            overwrites[get_team_role(interaction.guild, settings=settings)] = discord.PermissionOverwrite(view_channel=True, read_message_history=True, send_messages=True)
+            overwrites[await get_team_role(interaction.guild, settings=settings)] = discord.PermissionOverwrite(view_channel=True, read_message_history=True, send_messages=True)
         if private:
             await interaction.user.add_roles(new_role)
 
@@ -219,12 +222,12 @@ class CtfCommands(app_commands.Group):
 
         voice_channels = await create_voice_channels(interaction.guild, name, overwrites, settings)
         ctf_db = Ctf(name=name, channel_id=new_channel.id, role_id=new_role.id, info=info, info_id=info_msg.id, voice_channels=voice_channels, private=private)
-        ctf_db.save()
+        await repository.save(ctf_db)
 
         await interaction.edit_original_response(content=f"Created ctf {new_channel.mention}")
 
         if not private and not settings.use_team_role_as_acl:
-            for member in get_team_role(interaction.guild, settings=settings).members:
+            for member in (await get_team_role(interaction.guild, settings=settings)).members:
                 await member.add_roles(new_role)
 
     @app_commands.command(description="Generate an invitation for the CTF")
@@ -234,7 +237,7 @@ class CtfCommands(app_commands.Group):
         ctf_db = await get_ctf_db(interaction.channel, archived=False, allow_chall=False)
         assert isinstance(interaction.channel, discord.TextChannel)
 
-        settings = get_settings(interaction.guild)
+        settings = await get_settings(interaction.guild)
         if not settings.invite_channel:
             raise app_commands.AppCommandError("No invite channel set")
 
@@ -300,7 +303,7 @@ class CtfCommands(app_commands.Group):
                 async def on_submit(self, submit_interaction: discord.Interaction):
                     info["creds"] = self.edit.value
                     ctf_db.info = info
-                    ctf_db.save()
+                    await repository.save(ctf_db)
                     await interaction.channel.get_partial_message(ctf_db.info_id).edit(content=create_info_message(info))
                     await submit_interaction.response.send_message("Updated info", ephemeral=True)
 
@@ -324,7 +327,7 @@ class CtfCommands(app_commands.Group):
             raise app_commands.AppCommandError("Invalid field")
 
         ctf_db.info = info
-        ctf_db.save()
+        await repository.save(ctf_db)
         await interaction.channel.get_partial_message(ctf_db.info_id).edit(content=create_info_message(info))
         await interaction.response.send_message("Updated info", ephemeral=True)
 
@@ -337,14 +340,20 @@ class CtfCommands(app_commands.Group):
 
         await interaction.response.defer()
 
-        for chall in Challenge.objects(ctf=ctf_db):
+        settings = await get_settings(interaction.guild)
+        archive_category = await get_archive_category(interaction.guild, settings=settings)
+
+        moves = []
+        for chall in await repository.get_challenges(ctf_db):
             channel = interaction.guild.get_channel(chall.channel_id)
             if channel:
-                await move_channel(channel, get_archive_category(interaction.guild))
+                moves.append((channel, archive_category))
             else:
-                chall.delete()
+                await repository.delete(chall)
+        await move_channels(moves, progress=lambda done, total: interaction.edit_original_response(
+            content=f"Archiving... Moved {done}/{total} channels"))
 
-        await move_channel(interaction.channel, get_ctf_archive_category(interaction.guild), challenge=False)
+        await move_channel(interaction.channel, await get_ctf_archive_category(interaction.guild, settings=settings), challenge=False)
 
         # Remove voice channels
         for channel_id in ctf_db.voice_channels:
@@ -356,7 +365,7 @@ class CtfCommands(app_commands.Group):
                     pass
         ctf_db.voice_channels = []
         ctf_db.archived = True
-        ctf_db.save()
+        await repository.save(ctf_db)
         await interaction.edit_original_response(content="The CTF has been archived")
 
     @app_commands.command(description="Unarchive a CTF")
@@ -368,24 +377,29 @@ class CtfCommands(app_commands.Group):
 
         await interaction.response.defer()
 
-        settings = get_settings(interaction.guild)
+        settings = await get_settings(interaction.guild)
+        complete_category = await get_complete_category(interaction.guild, settings=settings)
+        incomplete_category = await get_incomplete_category(interaction.guild, settings=settings)
 
-        for chall in Challenge.objects(ctf=ctf_db):
+        moves = []
+        for chall in await repository.get_challenges(ctf_db):
             channel = interaction.guild.get_channel(chall.channel_id)
-            target_category = get_complete_category(interaction.guild) if chall.solved else get_incomplete_category(interaction.guild)
+            target_category = complete_category if chall.solved else incomplete_category
             if channel:
-                await move_channel(channel, target_category)
+                moves.append((channel, target_category))
             else:
-                chall.delete()
+                await repository.delete(chall)
+        await move_channels(moves, progress=lambda done, total: interaction.edit_original_response(
+            content=f"Unarchiving... Moved {done}/{total} channels"))
 
-        await move_channel(interaction.channel, get_ctfs_category(interaction.guild), challenge=False)
+        await move_channel(interaction.channel, await get_ctfs_category(interaction.guild, settings=settings), challenge=False)
 
         # Re-create voice channels
         voice_channels = await create_voice_channels(interaction.guild, ctf_db.name, interaction.channel.overwrites, settings)
 
         ctf_db.voice_channels = voice_channels
         ctf_db.archived = False
-        ctf_db.save()
+        await repository.save(ctf_db)
         await interaction.edit_original_response(content="The CTF has been unarchived")
 
     @app_commands.command(description="Rename a CTF and its channels")
@@ -404,11 +418,11 @@ class CtfCommands(app_commands.Group):
         if ctf_db.info.get('title') == ctf_db.name:
             ctf_db.info['title'] = name
         ctf_db.name = name
-        ctf_db.save()
+        await repository.save(ctf_db)
 
         await interaction.channel.edit(name=name)
 
-        for chall in Challenge.objects(ctf=ctf_db):
+        for chall in await repository.get_challenges(ctf_db):
             channel = interaction.guild.get_channel(chall.channel_id)
             if channel:
                 if chall.category:
@@ -416,7 +430,7 @@ class CtfCommands(app_commands.Group):
                 else:
                     await channel.edit(name=f"{name}-{chall.name}")
             else:
-                chall.delete()
+                await repository.delete(chall)
 
         # Rename voice channels
         for i, channel_id in enumerate(ctf_db.voice_channels):
@@ -428,45 +442,89 @@ class CtfCommands(app_commands.Group):
         await interaction.edit_original_response(content="The CTF has been renamed")
 
     @app_commands.command(description="Export an archived CTF")
+    @app_commands.describe(incremental="Only add new messages to the existing backup, without re-exporting it")
     @app_commands.guild_only
     @app_commands.check(is_team_admin)
-    async def export(self, interaction: discord.Interaction):
+    async def export(self, interaction: discord.Interaction, incremental: bool = False):
         ctf_db = await get_ctf_db(interaction.channel, archived=None, allow_chall=False)
         assert isinstance(interaction.channel, discord.TextChannel)
 
-        export_channel = get_export_channel(interaction.guild)
+        export_channel = await get_export_channel(interaction.guild)
 
         await interaction.response.defer()
 
         channels = [interaction.channel]
 
-        for chall in Challenge.objects(ctf=ctf_db):
+        for chall in await repository.get_challenges(ctf_db):
             channel = interaction.guild.get_channel(chall.channel_id)
             if channel:
                 channels.append(channel)
             else:
-                chall.delete()
+                await repository.delete(chall)
 
         attachment_dir = Path(config.backups_dir) / str(interaction.guild_id) / f"{interaction.channel_id}_{ctf_db.name}"
+        export_path = attachment_dir.parent / f"{interaction.channel_id}_{ctf_db.name}.jsonl"
+        if incremental and (existing := find_export(attachment_dir.parent, export_path.stem)) and \
+                existing.suffix == ARCHIVE_SUFFIX:
+            # Archiving removes the checkpoint, and the archive would still shadow the new .jsonl
+            raise app_commands.AppCommandError("The backup has been archived and cannot be updated incrementally")
         try:
             attachment_dir.mkdir(parents=True, exist_ok=True)
         except OSError:
             logging.warning(f"Failed to create directory {attachment_dir}")
             raise app_commands.AppCommandError("Failed to create attachment directory")
 
-        ctf_export = await export_channels(channels, attachment_dir)
-
-        filepath = attachment_dir.parent / f"{interaction.channel_id}_{ctf_db.name}.json"
-
         try:
-            with open(filepath, 'w') as f:
-                f.write(json.dumps(ctf_export, separators=(",", ":")))
-        except FileNotFoundError:
+            new_messages = await export_channels(channels, attachment_dir, export_path, incremental=incremental)
+        except OSError:
             # Export dir was not created
             raise app_commands.AppCommandError("Invalid file permissions when exporting CTF")
 
-        await interaction.edit_original_response(content=f"The CTF has been exported. It can safely be deleted now.")
-        await reexport_ctf(export_channel, ctf_export, attachment_dir)
+        try:
+            await asyncio.to_thread(index_export, export_path)
+        except (OSError, sqlite3.Error):
+            logging.exception(f"Failed to index {export_path}")
+
+        if incremental:
+            await interaction.edit_original_response(content=f"The backup has been updated with {new_messages} new messages")
+            return
+
+        if config.archive_exports:
+            try:
+                export_path = await asyncio.to_thread(archive_export, export_path, Path(config.backups_dir))
+            except OSError:
+                logging.exception(f"Failed to archive {export_path}")
+
+        planned = await asyncio.to_thread(count_planned_messages, export_path)
+        await interaction.edit_original_response(content=f"The CTF has been exported. It can safely be deleted now.\n"
+                                                         f"Re-exporting {planned} messages...")
+        pool = await reexport_ctf(export_channel, export_path)
+        if pool:
+            await interaction.edit_original_response(content=f"The CTF has been exported. It can safely be deleted now.\n"
+                                                             f"Re-exported {pool.sent} messages ({pool.rate:.2f} messages/s)")
+
+    @app_commands.command(description="Re-export the backup of a CTF, continuing an interrupted re-export")
+    @app_commands.describe(restart="Start over in a new thread instead of continuing an interrupted re-export")
+    @app_commands.guild_only
+    @app_commands.check(is_team_admin)
+    async def reexport(self, interaction: discord.Interaction, restart: bool = False):
+        ctf_db = await get_ctf_db(interaction.channel, archived=None, allow_chall=False)
+
+        export_channel = await get_export_channel(interaction.guild)
+
+        export_path = find_export(Path(config.backups_dir) / str(interaction.guild_id), f"{interaction.channel_id}_{ctf_db.name}")
+        if export_path is None:
+            raise app_commands.AppCommandError("This CTF has not been exported")
+
+        await interaction.response.defer()
+
+        planned = await asyncio.to_thread(count_planned_messages, export_path)
+        await interaction.edit_original_response(content=f"Re-exporting {planned} messages...")
+        pool = await reexport_ctf(export_channel, export_path, resume=not restart)
+        if pool:
+            await interaction.edit_original_response(content=f"Re-exported {pool.sent} messages ({pool.rate:.2f} messages/s)")
+        else:
+            await interaction.edit_original_response(content="The backup is empty")
 
     @app_commands.command(description="Delete a CTF and its channels")
     @app_commands.guild_only
@@ -481,7 +539,7 @@ class CtfCommands(app_commands.Group):
             raise app_commands.AppCommandError("Wrong security parameter")
         await interaction.response.defer()
 
-        for chall in Challenge.objects(ctf=ctf_db):
+        for chall in await repository.get_challenges(ctf_db):
             try:
                 await delete_channel(interaction.guild.get_channel(chall.channel_id))
             except AttributeError:
@@ -502,15 +560,14 @@ class CtfCommands(app_commands.Group):
                     pass
 
         await delete_channel(interaction.channel)
-        Challenge.objects(ctf=ctf_db).delete()
-        ctf_db.delete()
+        await repository.delete_ctf(ctf_db)
 
 
 @app_commands.command(description="Add a user to the CTF")
 @app_commands.guild_only
 async def invite(interaction: discord.Interaction, user: discord.Member):
-    settings = get_settings(interaction.guild)
-    if settings.invite_admin_only and not get_admin_role(interaction.guild, settings=settings) in interaction.user.roles:
+    settings = await get_settings(interaction.guild)
+    if settings.invite_admin_only and not await get_admin_role(interaction.guild, settings=settings) in interaction.user.roles:
         raise app_commands.AppCommandError("Only team admins are allowed to run this command")
     ctf_db = await get_ctf_db(interaction.channel)
     assert isinstance(interaction.channel, discord.TextChannel)
@@ -522,8 +579,8 @@ async def invite(interaction: discord.Interaction, user: discord.Member):
 @app_commands.command(description="Add all members with a specific role to the CTF")
 @app_commands.guild_only
 async def inviterole(interaction: discord.Interaction, role: discord.Role):
-    settings = get_settings(interaction.guild)
-    if settings.invite_admin_only and not get_admin_role(interaction.guild, settings=settings) in interaction.user.roles:
+    settings = await get_settings(interaction.guild)
+    if settings.invite_admin_only and not await get_admin_role(interaction.guild, settings=settings) in interaction.user.roles:
         raise app_commands.AppCommandError("Only team admins are allowed to run this command")
     ctf_db = await get_ctf_db(interaction.channel)
     assert isinstance(interaction.channel, discord.TextChannel)
@@ -545,8 +602,8 @@ async def leave(interaction: discord.Interaction):
 
     await interaction.response.defer(ephemeral=True)
 
-    settings = get_settings(interaction.guild)
-    team_member = get_team_role(interaction.guild, settings=settings)
+    settings = await get_settings(interaction.guild)
+    team_member = await get_team_role(interaction.guild, settings=settings)
     ctf_role = interaction.guild.get_role(ctf_db.role_id)
     admin_channel = interaction.guild.get_channel(settings.admin_channel)
     success = False
@@ -558,7 +615,7 @@ async def leave(interaction: discord.Interaction):
             await admin_channel.send(f"{interaction.user.mention} left {interaction.channel.mention}")
 
     if team_member in interaction.user.roles and interaction.channel.permissions_for(team_member).read_messages:
-        inactive_role = get_inactive_role(interaction.guild, settings=settings)
+        inactive_role = await get_inactive_role(interaction.guild, settings=settings)
         await interaction.user.remove_roles(team_member, reason="Left team temporarily")
         await interaction.user.add_roles(inactive_role, reason="Left team temporarily")
         success = True
@@ -574,9 +631,9 @@ async def leave(interaction: discord.Interaction):
 @app_commands.command(description="Rejoin the team member role after going inactive")
 @app_commands.guild_only
 async def rejoin(interaction: discord.Interaction):
-    settings = get_settings(interaction.guild)
-    team_member = get_team_role(interaction.guild, settings=settings)
-    inactive_role = get_inactive_role(interaction.guild, settings=settings)
+    settings = await get_settings(interaction.guild)
+    team_member = await get_team_role(interaction.guild, settings=settings)
+    inactive_role = await get_inactive_role(interaction.guild, settings=settings)
 
     if inactive_role not in interaction.user.roles:
         raise app_commands.AppCommandError("You are not marked as inactive")
@@ -1,3 +1,7 @@
+import json
+import time
+import asyncio
+import logging
 import discord
 import aiohttp
 
@@ -5,28 +9,155 @@ from urllib.parse import quote_plus
 from dateutil import parser as dateutil_parser
 from discord import app_commands
 from bs4 import BeautifulSoup, element
-from datetime import datetime
+from datetime import datetime, timezone
 from tabulate import tabulate
 
 from psybot.utils import get_settings
 from psybot.config import config
 
 
+# Event info rarely changes, while rating pages change whenever a CTF is scored
+EVENT_TTL = 3600
+CACHE_SIZE = 256
+EVENT_LOOKUPS = 4
+
+
+class CachedResponse:
+    def __init__(self, status: int, text: str, etag: str | None, last_modified: str | None, ttl: int):
+        self.status = status
+        self.text = text
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires = time.monotonic() + ttl
+        self._soup = None
+
+    @property
+    def fresh(self) -> bool:
+        return time.monotonic() < self.expires
+
+    def json(self):
+        return json.loads(self.text)
+
+    def soup(self) -> BeautifulSoup:
+        # Parsing is the slow part of a cache hit, so the parsed page is kept with the response
+        if self._soup is None:
+            self._soup = BeautifulSoup(self.text, 'html.parser')
+        return self._soup
+
+
+class CtftimeHttp:
+    """Shared CTFtime session with a response cache. Expired entries are revalidated with ETag/Last-Modified,
+    and with stale=True an expired entry is returned immediately while it is revalidated in the background."""
+
+    def __init__(self, size: int = CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._session: aiohttp.ClientSession | None = None
+        self._entries: dict[str, CachedResponse] = {}
+        self._in_flight: dict[str, asyncio.Task] = {}
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # Created on first use, since the session has to be created inside the running event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        return self._session
+
+    async def close(self):
+        for task in list(self._in_flight.values()):
+            task.cancel()
+        if self._session is not None:
+            await self._session.close()
+
+    async def get(self, url: str, ttl: int, stale: bool = False) -> CachedResponse:
+        entry = self._entries.get(url)
+        if entry is not None and (entry.fresh or stale):
+            self.hits += 1
+            if not entry.fresh:
+                self._revalidate(url, ttl)
+            return entry
+        self.misses += 1
+        # Shielded, so one cancelled interaction does not cancel the fetch for everyone waiting on it
+        return await asyncio.shield(self._revalidate(url, ttl))
+
+    def _revalidate(self, url: str, ttl: int) -> asyncio.Task:
+        # Concurrent requests for the same url share one fetch
+        if url not in self._in_flight:
+            task = asyncio.create_task(self._fetch(url, ttl))
+            task.add_done_callback(lambda _: self._fetch_done(url, task))
+            self._in_flight[url] = task
+        return self._in_flight[url]
+
+    def _fetch_done(self, url: str, task: asyncio.Task):
+        self._in_flight.pop(url, None)
+        # Background revalidations have no one waiting for them, so their errors are logged here
+        if not task.cancelled() and (e := task.exception()) and not isinstance(e, app_commands.AppCommandError):
+            logging.error(f"Failed to fetch {url}", exc_info=e)
+
+    async def _fetch(self, url: str, ttl: int) -> CachedResponse:
+        entry = self._entries.get(url)
+        headers = {}
+        if entry is not None and entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry is not None and entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+
+        try:
+            async with self.session.get(url, headers=headers) as response:
+                if response.status == 304 and entry is not None:
+                    self.revalidated += 1
+                    entry.expires = time.monotonic() + ttl
+                    return entry
+                result = CachedResponse(response.status, await response.text(), response.headers.get('ETag'),
+                                        response.headers.get('Last-Modified'), ttl)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if entry is None:
+                raise app_commands.AppCommandError("Could not reach CTFtime")
+            logging.warning(f"Failed to revalidate {url}, using the cached response")
+            return entry
+
+        if result.status == 200:
+            self._entries.pop(url, None)
+            self._entries[url] = result
+            while len(self._entries) > self.size:
+                self._entries.pop(next(iter(self._entries)))
+        return result
+
+
+ctftime_http = CtftimeHttp()
+# Finished events never change, so they are kept for as long as the bot runs
+finished_events: dict[int, dict] = {}
+
+
 class Ctftime(app_commands.Group):
 
     @staticmethod
     async def get_ctf_info(event_id: int) -> dict:
         event_url = f'{config.ctftime_url}/api/v1/events/{event_id}/'
-        async with aiohttp.ClientSession() as session, session.get(event_url) as response:
-            if response.status != 200:
-                return None
-            data = await response.json()
-            return {
-                'title': data['title'],
-                'url': data['url'],
-                'start': int(dateutil_parser.parse(data["start"]).timestamp()),
-                'end': int(dateutil_parser.parse(data["finish"]).timestamp()),
-            }
+        response = await ctftime_http.get(event_url, EVENT_TTL)
+        if response.status != 200:
+            return None
+        data = response.json()
+        return {
+            'title': data['title'],
+            'url': data['url'],
+            'start': int(dateutil_parser.parse(data["start"]).timestamp()),
+            'end': int(dateutil_parser.parse(data["finish"]).timestamp()),
+        }
+
+    @staticmethod
+    async def get_event(event_id: int) -> dict | None:
+        if event_id in finished_events:
+            return finished_events[event_id]
+        response = await ctftime_http.get(f'{config.ctftime_url}/api/v1/events/{event_id}/', EVENT_TTL)
+        if response.status != 200:
+            return None
+        data = response.json()
+        if dateutil_parser.parse(data['finish']) < datetime.now(timezone.utc):
+            finished_events[event_id] = data
+        return data
 
     @staticmethod
     def get_table_from_html(tbl: element.Tag, raw: bool = False) -> tuple[list[str], list]:
@@ -61,12 +192,12 @@ class Ctftime(app_commands.Group):
         return year
 
     @staticmethod
-    def get_team_url(interaction, team) -> str | None:
+    async def get_team_url(interaction, team) -> str | None:
         if team is None:
             if interaction.guild is None:
                 return None
 
-            settings = get_settings(interaction.guild)
+            settings = await get_settings(interaction.guild)
             if not settings.ctftime_team:
                 return None
             team = settings.ctftime_team
@@ -77,37 +208,41 @@ class Ctftime(app_commands.Group):
 
     @staticmethod
     async def get_team_top10(team_url, year) -> tuple[str, list, float]:
-        async with aiohttp.ClientSession() as session, session.get(team_url) as response:
-            if response.status != 200:
-                raise app_commands.AppCommandError("Unknown team")
-
-            html = await response.text()
-            soup = BeautifulSoup(html, 'html.parser')
-            team_name = soup.find(class_='page-header').text.strip()
-
-            year_rating = soup.find(id=f'rating_{year}')
-            if year_rating is None:
-                raise app_commands.AppCommandError("Invalid year")
-            _, tbl = Ctftime.get_table_from_html(year_rating.find('table'))
-
-            h3_tag = soup.find('h3', text='Organized CTF events')
-            organized_tag = h3_tag.find_next_sibling('table') if h3_tag else None
-
-            if organized_tag:
-                _, organized_tbl = Ctftime.get_table_from_html(organized_tag, raw=True)
-                for name, weight in organized_tbl:
-                    event_id = name['href'].split("/")[-1]
-
-                    async with session.get(f'{config.ctftime_url}/api/v1/events/{event_id}/') as response:
-                        if response.status != 200:
-                            break
-                        resp = await response.json()
-                        if int(resp['finish'][:4]) != year:
-                            break
-                    tbl.append(['-', name.text, '-', str(float(weight.text)*2)])
-            tbl = sorted(tbl, key=lambda row: -float(row[3].replace('*','')))[:10]
-            s = sum(float(row[3].replace('*','')) for row in tbl)
-            return team_name, tbl, s
+        response = await ctftime_http.get(team_url, config.ctftime_cache_ttl)
+        if response.status != 200:
+            raise app_commands.AppCommandError("Unknown team")
+
+        soup = response.soup()
+        team_name = soup.find(class_='page-header').text.strip()
+
+        year_rating = soup.find(id=f'rating_{year}')
+        if year_rating is None:
+            raise app_commands.AppCommandError("Invalid year")
+        _, tbl = Ctftime.get_table_from_html(year_rating.find('table'))
+
+        h3_tag = soup.find('h3', text='Organized CTF events')
+        organized_tag = h3_tag.find_next_sibling('table') if h3_tag else None
+
+        if organized_tag:
+            _, organized_tbl = Ctftime.get_table_from_html(organized_tag, raw=True)
+            semaphore = asyncio.Semaphore(EVENT_LOOKUPS)
+
+            async def lookup(event_id: int) -> dict | None:
+                async with semaphore:
+                    return await Ctftime.get_event(event_id)
+
+            # Events are looked up concurrently, but still checked in table order
+            events = await asyncio.gather(*(lookup(int(name['href'].split("/")[-1])) for name, _ in organized_tbl),
+                                          return_exceptions=True)
+            for (name, weight), event in zip(organized_tbl, events):
+                if isinstance(event, BaseException):
+                    raise event
+                if event is None or int(event['finish'][:4]) != year:
+                    break
+                tbl.append(['-', name.text, '-', str(float(weight.text)*2)])
+        tbl = sorted(tbl, key=lambda row: -float(row[3].replace('*','')))[:10]
+        s = sum(float(row[3].replace('*','')) for row in tbl)
+        return team_name, tbl, s
 
     @app_commands.command(description="Display top teams for a specified year and/or country")
     async def top(self, interaction: discord.Interaction, country: str | None, year: int | None):
@@ -120,17 +255,17 @@ class Ctftime(app_commands.Group):
         if country is not None:
             stats_url += country.upper()
 
-        async with aiohttp.ClientSession() as session, session.get(stats_url) as response:
-            if response.status != 200:
-                raise app_commands.AppCommandError("Unknown country")
+        # The rankings only change when a CTF is scored, so a stale page is shown while it is refreshed
+        response = await ctftime_http.get(stats_url, config.ctftime_cache_ttl, stale=True)
+        if response.status != 200:
+            raise app_commands.AppCommandError("Unknown country")
 
-            html = await response.text()
-            soup = BeautifulSoup(html, 'html.parser')
+        soup = response.soup()
 
-            if country:
-                country_name = soup.find(class_='flag').parent.text.strip()
+        if country:
+            country_name = soup.find(class_='flag').parent.text.strip()
 
-            headers, tbl = self.get_table_from_html(soup.find('table'))
+        headers, tbl = self.get_table_from_html(soup.find('table'))
 
         if country is None:
             out = "**Showing top teams globally**"
@@ -153,7 +288,7 @@ class Ctftime(app_commands.Group):
     async def team(self, interaction: discord.Interaction, team: str | None, year: int | None):
         year = self.check_year(year)
 
-        url = self.get_team_url(interaction, team)
+        url = await self.get_team_url(interaction, team)
         if url is None:
             raise app_commands.AppCommandError("Please specify team")
 
@@ -180,7 +315,7 @@ class Ctftime(app_commands.Group):
 
         await interaction.response.send_message(f"Rating points: {new_score:.03f}")
 
-        url = self.get_team_url(interaction, team)
+        url = await self.get_team_url(interaction, team)
         if url is None:
             return
 
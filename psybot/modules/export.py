@@ -4,20 +4,46 @@ import traceback
 import aiohttp
 import asyncio
 import json
+import io
+import shutil
 import os
+import time
+import hashlib
+import tempfile
+import itertools
+import collections
+import zipfile
+import contextlib
+import sqlite3
 
 from pathlib import Path
+from datetime import datetime, timedelta, timezone
+from typing import BinaryIO, Iterable, Iterator
 from dateutil import parser as dateutil_parser
 
+try:
+    import zstandard
+except ModuleNotFoundError:
+    zstandard = None
+
 try:
     from psybot.config import config
 except ModuleNotFoundError:
     class Config:
         def __init__(self):
             self.disable_download = False
+            self.export_concurrency = 4
+            self.download_workers = 4
+            self.export_edit_window = 24
+            self.archive_exports = False
+            self.reexport_webhooks = 4
     config = Config()
 
 
+EXPORT_VERSION = 2
+ARCHIVE_SUFFIX = ".archive"
+
+
 def user_to_dict(user: discord.Member | discord.User) -> dict:
     d = {
         "id": user.id,
@@ -30,75 +56,917 @@ def user_to_dict(user: discord.Member | discord.User) -> dict:
     return d
 
 
-async def export_channels(channels: list[discord.TextChannel], attachment_dir: Path) -> dict:
-    ctf_export = {"channels": []}
-    channels_and_threads = []
-    for channel in channels:
-        channels_and_threads.append(channel)
-        for thread in channel.threads:
-            channels_and_threads.append(thread)
-        async for thread in channel.archived_threads(private=False, limit=None):
-            channels_and_threads.append(thread)
-
-    async with aiohttp.ClientSession() as session:
-        for channel in channels_and_threads:
-            chan = {
-                "id": channel.id,
-                "name": channel.name,
-                "messages": [],
-                "pins": [m.id for m in await channel.pins()],
+class BlobStore:
+    """Content-addressed attachment storage shared by all exports. Blobs are stored as blobs/<sha256[:2]>/<sha256>,
+    and blobs/by-id/<attachment id> remembers which blob a Discord attachment was stored as."""
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    @classmethod
+    def for_export(cls, attachment_dir: Path) -> "BlobStore":
+        # attachment_dir is <backups>/<guild>/<channel>_<name>
+        return cls(attachment_dir.parent.parent / "blobs")
+
+    def path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest
+
+    def lookup(self, attachment_id: int) -> str | None:
+        try:
+            digest = (self.root / "by-id" / str(attachment_id)).read_text().strip()
+        except OSError:
+            return None
+        return digest if self.path(digest).exists() else None
+
+    def temp_file(self) -> tuple[Path, "io.BufferedWriter"]:
+        tmp_dir = self.root / "tmp"
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        fd, name = tempfile.mkstemp(dir=tmp_dir)
+        return Path(name), os.fdopen(fd, 'wb')
+
+    def commit(self, tmp_path: Path, digest: str, attachment_id: int | None):
+        path = self.path(digest)
+        if path.exists():
+            tmp_path.unlink()
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, path)
+        if attachment_id is not None:
+            (self.root / "by-id").mkdir(exist_ok=True)
+            (self.root / "by-id" / str(attachment_id)).write_text(digest)
+
+
+class Manifest:
+    """Maps the attachments of one export to blobs. Stored as manifest.json in the export's attachment directory.
+    Exports without a manifest keep their attachments as loose files named <msgid><j>_<filename>."""
+    FILENAME = "manifest.json"
+
+    def __init__(self, attachment_dir: Path, store: BlobStore, attachments: dict[str, str] | None = None,
+                 errors: dict[str, str] | None = None):
+        self.attachment_dir = attachment_dir
+        self.store = store
+        self.attachments = attachments if attachments is not None else {}
+        self.errors = errors if errors is not None else {}
+
+    @staticmethod
+    def key(message_id: int, j: int) -> str:
+        return f"{message_id}_{j}"
+
+    @classmethod
+    def load(cls, attachment_dir: Path) -> "Manifest":
+        try:
+            with open(attachment_dir / cls.FILENAME, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return cls(attachment_dir, BlobStore.for_export(attachment_dir))
+        return cls(attachment_dir, BlobStore(attachment_dir / data["blob_root"]), data["attachments"], data.get("errors"))
+
+    def save(self):
+        data = {
+            "blob_root": os.path.relpath(self.store.root, self.attachment_dir),
+            "attachments": self.attachments,
+            "errors": self.errors,
+        }
+        with open(self.attachment_dir / self.FILENAME, 'w') as f:
+            json.dump(data, f, separators=(",", ":"))
+
+    def add(self, message_id: int, j: int, digest: str):
+        self.attachments[self.key(message_id, j)] = digest
+        self.errors.pop(self.key(message_id, j), None)
+
+    def add_error(self, message_id: int, j: int, error: str):
+        self.errors[self.key(message_id, j)] = error
+
+    def apply_errors(self, message: dict):
+        """Download errors are only known after the message has been written, so they are kept here"""
+        for j, attachment in enumerate(message["attachments"]):
+            if error := self.errors.get(self.key(message["id"], j)):
+                attachment["error"] = error
+
+    def path(self, message_id: int, j: int, filename: str) -> Path:
+        digest = self.attachments.get(self.key(message_id, j))
+        if digest is not None:
+            return self.store.path(digest)
+        return self.attachment_dir / "{}{}_{}".format(message_id, j, filename.replace('/', ''))
+
+
+class AttachmentDownloader:
+    """Downloads attachments into the blob store with a pool of workers, so the history walk never waits for a
+    download. Larger files are started first, so a big file found late doesn't become the tail of the export."""
+    RETRIES = 3
+    WRITE_BUFFER = 1 << 20
+
+    def __init__(self, workers: int, manifest: Manifest):
+        self.workers = max(1, workers)
+        self.manifest = manifest
+        self.store = manifest.store
+        self.queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self.order = itertools.count()
+        self.in_flight: dict[int, asyncio.Future] = {}
+        self.total_bytes = 0
+        self.files = 0
+        self.reused = 0
+        self.started = 0.0
+        self.finished = None
+        self.session = None
+        self.tasks = []
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.workers, keepalive_timeout=60, ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(sock_read=60))
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self.started = time.perf_counter()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                await self.queue.join()
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            await self.session.close()
+            self.finished = time.perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def throughput(self) -> float:
+        return self.total_bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def submit(self, message_id: int, j: int, url: str, attachment_id: int, size: int = 0):
+        self.queue.put_nowait((-size, next(self.order), message_id, j, url, attachment_id))
+
+    async def _worker(self):
+        while True:
+            _, _, message_id, j, url, attachment_id = await self.queue.get()
+            try:
+                digest, error = await self._fetch(url, attachment_id)
+                if digest is not None:
+                    self.manifest.add(message_id, j, digest)
+                elif error is not None:
+                    self.manifest.add_error(message_id, j, error)
+            finally:
+                self.queue.task_done()
+
+    async def _fetch(self, url: str, attachment_id: int) -> tuple[str | None, str | None]:
+        # The same attachment can be referenced more than once, e.g. when a message is forwarded or exported again
+        if attachment_id in self.in_flight:
+            return await asyncio.shield(self.in_flight[attachment_id])
+        # Registered before the first await, so other workers wait for this one instead of downloading it again
+        future = self.in_flight[attachment_id] = asyncio.get_running_loop().create_future()
+        result = None, "Download cancelled"
+        try:
+            digest = await asyncio.to_thread(self.store.lookup, attachment_id)
+            if digest is not None:
+                self.reused += 1
+                result = digest, None
+            else:
+                result = await self._download(url, attachment_id)
+        finally:
+            future.set_result(result)
+        return result
+
+    async def _download(self, url: str, attachment_id: int) -> tuple[str | None, str | None]:
+        error = None
+        for attempt in range(self.RETRIES):
+            if attempt:
+                await asyncio.sleep(2 ** attempt)
+            try:
+                async with self.session.get(url) as resp:
+                    if resp.status != 200:
+                        logging.warning(f"Export: failed with status {resp.status}")
+                        error = f"Failed with status {resp.status}"
+                        if resp.status == 429 or resp.status >= 500:
+                            continue
+                        return None, error
+                    digest, size = await self._write(resp, attachment_id)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.warning(f"Export: failed to download {url}: {e}")
+                error = str(e)
+                continue
+            except Exception as e:
+                traceback.print_exc()
+                return None, str(e)
+            self.total_bytes += size
+            self.files += 1
+            return digest, None
+        return None, error
+
+    async def _write(self, resp: aiohttp.ClientResponse, attachment_id: int) -> tuple[str, int]:
+        tmp_path, f = await asyncio.to_thread(self.store.temp_file)
+        sha = hashlib.sha256()
+        size = 0
+        try:
+            buffer = bytearray()
+            async for chunk in resp.content.iter_any():
+                buffer += chunk
+                if len(buffer) >= self.WRITE_BUFFER:
+                    sha.update(buffer)
+                    await asyncio.to_thread(f.write, bytes(buffer))
+                    size += len(buffer)
+                    buffer.clear()
+            if buffer:
+                sha.update(buffer)
+                await asyncio.to_thread(f.write, bytes(buffer))
+                size += len(buffer)
+        except BaseException:
+            await asyncio.to_thread(f.close)
+            tmp_path.unlink(missing_ok=True)
+            raise
+        await asyncio.to_thread(f.close)
+        await asyncio.to_thread(self.store.commit, tmp_path, sha.hexdigest(), attachment_id)
+        return sha.hexdigest(), size
+
+
+async def _list_threads(channel: discord.TextChannel) -> list[discord.TextChannel | discord.Thread]:
+    threads = [channel, *channel.threads]
+    async for thread in channel.archived_threads(private=False, limit=None):
+        threads.append(thread)
+    return threads
+
+
+def message_to_dict(message: discord.Message) -> dict:
+    entry = {
+        "id": message.id,
+        "created_at": message.created_at.isoformat(),
+        "content": message.content,
+        "author": user_to_dict(message.author),
+        "attachments": [{"filename": a.filename, "url": str(a.url)} for a in message.attachments],
+        "edited_at": message.edited_at.isoformat() if message.edited_at is not None else None,
+        "embeds": [e.to_dict() for e in message.embeds],
+        "mentions": [user_to_dict(mention) for mention in message.mentions],
+        "channel_mentions": [{"id": c.id, "name": c.name} for c in message.channel_mentions],
+        "reactions": [
+            {
+                "count": r.count,
+                "emoji": r.emoji if isinstance(r.emoji, str) else {"name": r.emoji.name, "url": r.emoji.url},
+            } for r in message.reactions
+        ]
+    }
+    if message.mention_everyone:
+        entry["mention_everyone"] = True
+    if message.thread:
+        entry['thread'] = message.thread.id
+    return entry
+
+
+class RecordInterner:
+    """Replaces message authors, mentions and embeds with references to user and embed records (export version 2).
+    A record is written before the first message in the channel that uses it, so each channel can be read on its own."""
+
+    def __init__(self):
+        self.users: dict[int, dict] = {}
+        self.embeds: set[str] = set()
+
+    def message(self, message: dict) -> list[dict]:
+        records = []
+        message = {
+            **message,
+            "author": self._user(message["author"], records),
+            "mentions": [self._user(user, records) for user in message["mentions"]],
+            "embeds": [self._embed(embed, records) for embed in message["embeds"]],
+        }
+        records.append(message)
+        return records
+
+    def _user(self, user: dict, records: list[dict]) -> int:
+        if self.users.get(user["id"]) != user:
+            self.users[user["id"]] = user
+            records.append({"type": "user", **user})
+        return user["id"]
+
+    def _embed(self, embed: dict, records: list[dict]) -> str:
+        key = hashlib.sha1(json.dumps(embed, sort_keys=True).encode()).hexdigest()[:16]
+        if key not in self.embeds:
+            self.embeds.add(key)
+            records.append({"type": "embed", "id": key, "embed": embed})
+        return key
+
+
+def resolve_records(records: Iterable[dict]) -> Iterator[dict]:
+    """Turns version 2 records back into channel and message records with the full author, mention and embed dicts"""
+    users = {}
+    embeds = {}
+    for record in records:
+        if record["type"] == "user":
+            users[record["id"]] = {k: v for k, v in record.items() if k != "type"}
+        elif record["type"] == "embed":
+            embeds[record["id"]] = record["embed"]
+        elif record["type"] == "message" and isinstance(record["author"], int):
+            yield {
+                **record,
+                "author": users[record["author"]],
+                "mentions": [users[user_id] for user_id in record["mentions"]],
+                "embeds": [embeds[key] for key in record["embeds"]],
             }
+        else:
+            yield record
 
-            if hasattr(channel, "topic") and channel.topic:
-                chan["topic"] = channel.topic
-            if isinstance(channel, discord.Thread):
-                chan["thread_parent"] = channel.parent_id
-
-            async for message in channel.history(limit=None, oldest_first=True):
-                entry = {
-                    "id": message.id,
-                    "created_at": message.created_at.isoformat(),
-                    "content": message.content,
-                    "author": user_to_dict(message.author),
-                    "attachments": [{"filename": a.filename, "url": str(a.url)} for a in message.attachments],
-                    "edited_at": message.edited_at.isoformat() if message.edited_at is not None else None,
-                    "embeds": [e.to_dict() for e in message.embeds],
-                    "mentions": [user_to_dict(mention) for mention in message.mentions],
-                    "channel_mentions": [{"id": c.id, "name": c.name} for c in message.channel_mentions],
-                    "reactions": [
-                        {
-                            "count": r.count,
-                            "emoji": r.emoji if isinstance(r.emoji, str) else {"name": r.emoji.name, "url": r.emoji.url},
-                        } for r in message.reactions
-                    ]
-                }
-                if message.mention_everyone:
-                    entry["mention_everyone"] = True
-                if message.thread:
-                    entry['thread'] = message.thread.id
-
-                if not config.disable_download:
-                    for j, attachment in enumerate(entry["attachments"]):
-                        file_path = attachment_dir / "{}{}_{}".format(message.id, j, attachment["filename"].replace('/',''))
-                        try:
-                            async with session.get(attachment["url"]) as resp:
-                                if resp.status == 200:
-                                    with open(file_path, 'wb') as f:
-                                        while True:
-                                            chunk = await resp.content.readany()
-                                            if not chunk:
-                                                break
-                                            f.write(chunk)
-                                else:
-                                    logging.warning(f"Export: failed with status {resp.status}")
-                                    attachment["error"] = f"Failed with status {resp.status}"
-                        except Exception as e:
-                            traceback.print_exc()
-                            attachment["error"] = str(e)
-
-                chan["messages"].append(entry)
-            ctf_export["channels"].append(chan)
-    return ctf_export
+
+def convert_export(source: Path) -> Path:
+    """Converts a version 1 export (.json or .jsonl) to a version 2 .jsonl export next to it, which uses the same
+    attachment directory"""
+    destination = source.with_suffix(".jsonl")
+    tmp_path = source.with_suffix(".tmp")
+    interner = None
+    with open(tmp_path, 'w') as out:
+        out.write(json.dumps({"type": "export", "version": EXPORT_VERSION}) + "\n")
+        for record in read_export(source):
+            if record["type"] == "channel":
+                interner = RecordInterner()
+                out.write(json.dumps(record, separators=(",", ":")) + "\n")
+            elif record["type"] == "message":
+                for r in interner.message(record):
+                    out.write(json.dumps(r, separators=(",", ":")) + "\n")
+    os.replace(tmp_path, destination)
+    return destination
+
+
+class ExportWriter:
+    """Writes export records as JSON lines, a page at a time, without blocking the event loop"""
+    PAGE = 100
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.file = None
+        self.lines = []
+
+    async def __aenter__(self):
+        self.file = await asyncio.to_thread(open, self.path, 'w')
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await self.flush()
+        finally:
+            await asyncio.to_thread(self.file.close)
+
+    async def write(self, record: dict):
+        self.lines.append(json.dumps(record, separators=(",", ":")) + "\n")
+        if len(self.lines) >= self.PAGE:
+            await self.flush()
+
+    async def flush(self):
+        if self.lines:
+            data, self.lines = "".join(self.lines), []
+            await asyncio.to_thread(self.file.write, data)
+
+
+async def _export_channel(channel: discord.TextChannel | discord.Thread, downloader: AttachmentDownloader, part: Path,
+                          after: int | None = None, exported: int | None = None) -> tuple[int, int | None]:
+    """Writes the channel record and all messages after the given message id to part.
+    Returns the number of messages newer than the exported message id, and the id of the last message"""
+    header = {
+        "type": "channel",
+        "id": channel.id,
+        "name": channel.name,
+        "pins": [m.id for m in await channel.pins()],
+    }
+
+    if hasattr(channel, "topic") and channel.topic:
+        header["topic"] = channel.topic
+    if isinstance(channel, discord.Thread):
+        header["thread_parent"] = channel.parent_id
+
+    count = 0
+    last_id = None
+    interner = RecordInterner()
+    async with ExportWriter(part) as writer:
+        await writer.write(header)
+        history_after = discord.Object(after) if after is not None else None
+        async for message in channel.history(limit=None, after=history_after, oldest_first=True):
+            if not config.disable_download:
+                for j, a in enumerate(message.attachments):
+                    downloader.submit(message.id, j, str(a.url), a.id, a.size)
+            for record in interner.message({"type": "message", "channel": channel.id, **message_to_dict(message)}):
+                await writer.write(record)
+            if exported is None or message.id > exported:
+                count += 1
+            last_id = message.id
+    return count, last_id
+
+
+class Checkpoint:
+    """The last exported message of each channel and thread, stored as checkpoint.json in the attachment directory.
+    Incremental exports only fetch messages after these, plus a window of recent messages to pick up edits."""
+    FILENAME = "checkpoint.json"
+
+    def __init__(self, exported_at: datetime, channels: dict[int, int]):
+        self.exported_at = exported_at
+        self.channels = channels
+
+    @classmethod
+    def load(cls, attachment_dir: Path) -> "Checkpoint | None":
+        try:
+            with open(attachment_dir / cls.FILENAME, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return cls(datetime.fromisoformat(data["exported_at"]), {int(k): v for k, v in data["channels"].items()})
+
+    def save(self, attachment_dir: Path):
+        with open(attachment_dir / self.FILENAME, 'w') as f:
+            json.dump({"exported_at": self.exported_at.isoformat(), "channels": self.channels}, f)
+
+    def fetch_after(self, channel_id: int) -> int | None:
+        last_id = self.channels.get(channel_id)
+        if last_id is None:
+            return None
+        edit_window = discord.utils.time_snowflake(self.exported_at - timedelta(hours=config.export_edit_window))
+        return min(last_id, edit_window)
+
+
+def _split_export(export_path: Path, parts_dir: Path) -> dict[int, Path]:
+    """Splits an existing export into one file per channel"""
+    old_parts = {}
+    f = None
+    try:
+        for record in read_export(export_path, resolve=False):
+            if record["type"] == "channel":
+                if f:
+                    f.close()
+                old_parts[record["id"]] = parts_dir / f"old_{record['id']}.jsonl"
+                f = open(old_parts[record["id"]], 'w')
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+    finally:
+        if f:
+            f.close()
+    return old_parts
+
+
+def _read_part(part: Path) -> Iterator[dict]:
+    with open(part, 'r') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def _merge_part(out: io.TextIOBase, old_part: Path | None, new_part: Path, last_id: int | None):
+    """Writes the new channel record, the old messages with any refetched versions, and then the new messages.
+    Without a last_id (e.g. the channel was empty at the last export), the new part holds the full history."""
+    if old_part is None or last_id is None:
+        with open(new_part, 'r') as f:
+            shutil.copyfileobj(f, out)
+        return
+    new_records = _read_part(new_part)
+    out.write(json.dumps(next(new_records), separators=(",", ":")) + "\n")
+    refetched = {}
+    new_users = set()
+    for record in new_records:
+        if record["type"] != "message":
+            # Users and embeds go first, since refetched messages may refer to them
+            out.write(json.dumps(record, separators=(",", ":")) + "\n")
+            if record["type"] == "user":
+                new_users.add(record["id"])
+        elif record["id"] <= last_id:
+            refetched[record["id"]] = record
+    old_records = _read_part(old_part)
+    next(old_records)
+    for record in old_records:
+        if record["type"] == "user" and record["id"] in new_users:
+            # The last user record wins when resolving, so outdated versions must not follow the new ones
+            continue
+        if record["type"] == "message":
+            record = refetched.get(record["id"], record)
+        out.write(json.dumps(record, separators=(",", ":")) + "\n")
+    for record in _read_part(new_part):
+        if record["type"] == "message" and record["id"] > last_id:
+            out.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+
+def _write_export(parts_dir: Path, parts: list[Path], export_path: Path, old_parts: dict[int, Path],
+                  checkpoint: Checkpoint | None, channel_ids: list[int]):
+    tmp_path = parts_dir / "export.jsonl"
+    with open(tmp_path, 'w') as out:
+        out.write(json.dumps({"type": "export", "version": EXPORT_VERSION}) + "\n")
+        for channel_id, part in zip(channel_ids, parts):
+            old_part = old_parts.pop(channel_id, None)
+            _merge_part(out, old_part, part, checkpoint.channels.get(channel_id) if checkpoint else None)
+        # Keep channels that have been deleted since the last export
+        for old_part in old_parts.values():
+            with open(old_part, 'r') as f:
+                shutil.copyfileobj(f, out)
+    os.replace(tmp_path, export_path)
+
+
+async def export_channels(channels: list[discord.TextChannel], attachment_dir: Path, export_path: Path,
+                          incremental: bool = False) -> int:
+    """Export several channels and their threads at once, streaming records to export_path. discord.py already
+    queues requests per rate limit bucket, so this only bounds how many history walks run in parallel.
+    With incremental, only messages since the last export are fetched and merged into the existing export_path.
+    Returns the number of new messages."""
+    semaphore = asyncio.Semaphore(max(1, config.export_concurrency))
+
+    async def bounded(coro):
+        async with semaphore:
+            return await coro
+
+    started_at = datetime.now(timezone.utc)
+    checkpoint = Checkpoint.load(attachment_dir) if incremental and export_path.exists() else None
+    if incremental and checkpoint is None:
+        logging.info(f"Export: no checkpoint for {export_path}, doing a full export")
+
+    thread_lists = await asyncio.gather(*(bounded(_list_threads(channel)) for channel in channels))
+    channels_and_threads = [thread for threads in thread_lists for thread in threads]
+    channel_ids = [channel.id for channel in channels_and_threads]
+
+    # Channels are written to separate files while exporting, and joined in the original order afterwards
+    parts_dir = Path(tempfile.mkdtemp(prefix=f".{export_path.name}.", dir=export_path.parent))
+    parts = [parts_dir / f"{i}.jsonl" for i in range(len(channels_and_threads))]
+    manifest = Manifest.load(attachment_dir)
+    try:
+        old_parts = await asyncio.to_thread(_split_export, export_path, parts_dir) if checkpoint else {}
+        async with AttachmentDownloader(config.download_workers, manifest) as downloader:
+            jobs = []
+            for channel, part in zip(channels_and_threads, parts):
+                if checkpoint:
+                    job = _export_channel(channel, downloader, part, checkpoint.fetch_after(channel.id),
+                                          checkpoint.channels.get(channel.id))
+                else:
+                    job = _export_channel(channel, downloader, part)
+                jobs.append(bounded(job))
+            results = await asyncio.gather(*jobs)
+        await asyncio.to_thread(_write_export, parts_dir, parts, export_path, old_parts, checkpoint, channel_ids)
+    finally:
+        await asyncio.to_thread(shutil.rmtree, parts_dir, True)
+
+    if downloader.files or downloader.reused:
+        logging.info(f"Export: downloaded {downloader.files} attachments, {downloader.total_bytes} bytes "
+                     f"in {downloader.elapsed:.1f}s ({downloader.throughput:.0f} bytes/s), "
+                     f"reused {downloader.reused} stored attachments")
+
+    last_ids = dict(checkpoint.channels) if checkpoint else {}
+    for channel_id, (_, last_id) in zip(channel_ids, results):
+        if last_id is not None and last_id > last_ids.get(channel_id, 0):
+            last_ids[channel_id] = last_id
+    try:
+        await asyncio.to_thread(manifest.save)
+        await asyncio.to_thread(Checkpoint(started_at, last_ids).save, attachment_dir)
+    except OSError:
+        logging.warning(f"Failed to write attachment manifest and checkpoint in {attachment_dir}")
+    return sum(count for count, _ in results)
+
+
+def read_export(export_path: Path, resolve: bool = True) -> Iterator[dict]:
+    """Yields the records of an export: a channel record followed by the message records of that channel.
+    Old exports stored as a single JSON object are converted on the fly. Unless resolve is False, the user and
+    embed records of version 2 exports are merged back into the messages."""
+    if resolve:
+        yield from resolve_records(read_export(export_path, resolve=False))
+        return
+    with open(export_path, 'r') as f:
+        first = json.loads(f.readline() or "{}")
+        if "channels" in first:
+            for channel in first["channels"]:
+                messages = channel.pop("messages")
+                yield {"type": "channel", **channel}
+                for message in messages:
+                    yield {"type": "message", "channel": channel["id"], **message}
+            return
+        for line in f:
+            record = json.loads(line)
+            if record["type"] != "export":
+                yield record
+
+
+class LooseExport:
+    """An export stored as a .jsonl (or old .json) file, with its attachments in the blob store or next to it"""
+
+    def __init__(self, export_path: Path):
+        self.path = export_path
+        self.manifest = Manifest.load(export_path.with_suffix(""))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+    def records(self, resolve: bool = True) -> Iterator[dict]:
+        for record in read_export(self.path, resolve):
+            if record["type"] == "message":
+                self.manifest.apply_errors(record)
+            yield record
+
+    def attachment_path(self, message_id: int, j: int, filename: str) -> str:
+        return str(self.manifest.path(message_id, j, filename))
+
+    def attachment_size(self, message_id: int, j: int, filename: str) -> int:
+        return os.stat(self.manifest.path(message_id, j, filename)).st_size
+
+    def open_attachment(self, message_id: int, j: int, filename: str) -> tuple[BinaryIO, int]:
+        f = open(self.manifest.path(message_id, j, filename), 'rb')
+        return f, os.fstat(f.fileno()).st_size
+
+
+class ArchiveExport:
+    """An export packed into a single zip container by pack_archive. Each channel is a separately compressed
+    member, so single channels and attachments can be read without decompressing the rest of the archive."""
+
+    def __init__(self, archive_path: Path, dictionary_dir: Path | None = None):
+        self.path = archive_path
+        self.zip = zipfile.ZipFile(archive_path, 'r')
+        self.index = json.loads(self.zip.read("index.json"))
+        self.dictionary = None
+        if self.index["compression"] == "zstd":
+            if zstandard is None:
+                raise RuntimeError("The zstandard package is required to read this archive")
+            if self.index.get("dictionary"):
+                # Portable archive with its own copy of the dictionary
+                self.dictionary = zstandard.ZstdCompressionDict(self.zip.read(self.index["dictionary"]))
+            elif self.index.get("dictionary_id"):
+                # Archives are stored in <backups>/<guild>/, next to the shared dictionaries in <backups>/
+                dictionary_path = dictionary_file(dictionary_dir or archive_path.parent.parent, self.index["dictionary_id"])
+                self.dictionary = zstandard.ZstdCompressionDict(dictionary_path.read_bytes())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.zip.close()
+
+    def _read_member(self, member: str) -> Iterator[dict]:
+        with self.zip.open(member) as raw:
+            if self.index["compression"] == "zstd":
+                stream = zstandard.ZstdDecompressor(dict_data=self.dictionary).stream_reader(raw)
+            else:
+                stream = raw
+            for line in io.TextIOWrapper(stream, encoding="utf-8"):
+                yield json.loads(line)
+
+    def channel(self, channel_id: int) -> Iterator[dict]:
+        for channel in self.index["channels"]:
+            if channel["id"] == channel_id:
+                return resolve_records(self._read_member(channel["member"]))
+        raise KeyError(channel_id)
+
+    def records(self) -> Iterator[dict]:
+        for channel in self.index["channels"]:
+            yield from resolve_records(self._read_member(channel["member"]))
+
+    def attachment_path(self, message_id: int, j: int, filename: str) -> str:
+        return f"{self.path.name}:{self.index['attachments'].get(Manifest.key(message_id, j), filename)}"
+
+    def attachment_size(self, message_id: int, j: int, filename: str) -> int:
+        member = self.index["attachments"].get(Manifest.key(message_id, j))
+        if member is None:
+            raise FileNotFoundError(f"{filename} is not in {self.path.name}")
+        return self.zip.getinfo(member).file_size
+
+    def open_attachment(self, message_id: int, j: int, filename: str) -> tuple[BinaryIO, int]:
+        member = self.index["attachments"].get(Manifest.key(message_id, j))
+        if member is None:
+            raise FileNotFoundError(f"{filename} is not in {self.path.name}")
+        return self.zip.open(member), self.zip.getinfo(member).file_size
+
+
+def find_export(guild_dir: Path, stem: str) -> Path | None:
+    """Finds the backup <stem> in any of the export formats. If there are several, e.g. a full export was made
+    after the CTF was archived, the newest one is used."""
+    paths = [path for suffix in (ARCHIVE_SUFFIX, ".jsonl", ".json") if (path := guild_dir / (stem + suffix)).exists()]
+    return max(paths, key=lambda path: path.stat().st_mtime, default=None)
+
+
+def open_export(export_path: Path) -> LooseExport | ArchiveExport:
+    if export_path.suffix == ARCHIVE_SUFFIX:
+        return ArchiveExport(export_path)
+    return LooseExport(export_path)
+
+
+# Attachments with these extensions are already compressed
+STORED_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.mp4', '.webm', '.mp3', '.ogg', '.zip', '.gz', '.tgz',
+                     '.xz', '.bz2', '.7z', '.rar', '.zst', '.pdf', '.docx', '.xlsx', '.pptx', '.apk', '.jar'}
+DICTIONARY_SIZE = 112_640
+DICTIONARY_SAMPLES = 20_000
+DICTIONARY_MIN_SAMPLES = 200
+
+
+def dictionary_file(dictionary_dir: Path, dict_id: int) -> Path:
+    return dictionary_dir / f"zstd-{dict_id}.dict"
+
+
+def _export_samples(export: "LooseExport | ArchiveExport", limit: int) -> list[bytes]:
+    if isinstance(export, ArchiveExport):
+        records = itertools.chain.from_iterable(export._read_member(c["member"]) for c in export.index["channels"])
+    else:
+        records = export.records(resolve=False)
+    return [json.dumps(record, separators=(",", ":")).encode() for record in itertools.islice(records, limit)]
+
+
+def train_dictionary(dictionary_dir: Path, extra: list[Path] = ()) -> "zstandard.ZstdCompressionDict | None":
+    """Trains a new shared dictionary on samples from every export in dictionary_dir/<guild>/ and extra, and saves it
+    as zstd-<dict_id>.dict. Archives only refer to the id of their dictionary, so older dictionaries must be kept when
+    retraining. New archives use the newest dictionary."""
+    exports = [path for path in dictionary_dir.glob("*/*") if path.suffix in (ARCHIVE_SUFFIX, ".jsonl")]
+    exports += [path for path in extra if path not in exports]
+    if not exports:
+        return None
+    per_export = max(DICTIONARY_SAMPLES // len(exports), DICTIONARY_MIN_SAMPLES)
+    samples = []
+    for path in exports:
+        try:
+            with open_export(path) as export:
+                samples += _export_samples(export, per_export)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            logging.warning(f"Skipping {path} when training the archive dictionary")
+    try:
+        dictionary = zstandard.train_dictionary(DICTIONARY_SIZE, samples)
+    except zstandard.ZstdError:
+        return None  # Not enough samples
+    dictionary_file(dictionary_dir, dictionary.dict_id()).write_bytes(dictionary.as_bytes())
+    return dictionary
+
+
+def _zstd_dictionary(dictionary_dir: Path | None, export_path: Path) -> "zstandard.ZstdCompressionDict | None":
+    """Loads the newest shared dictionary, or trains the first one if there is none yet"""
+    if dictionary_dir is None:
+        return None
+    dictionaries = sorted(dictionary_dir.glob("zstd-*.dict"), key=lambda path: path.stat().st_mtime)
+    if dictionaries:
+        return zstandard.ZstdCompressionDict(dictionaries[-1].read_bytes())
+    return train_dictionary(dictionary_dir, [export_path])
+
+
+def pack_archive(export_path: Path, archive_path: Path, dictionary_dir: Path | None = None, portable: bool = False):
+    """Packs an export and its attachments into a single archive. Channels are compressed with zstd if the zstandard
+    package is installed, and with deflate otherwise. The zstd dictionary is trained on our own exports and shared
+    by all archives in dictionary_dir, so only its id is stored, unless portable is set."""
+    export = LooseExport(export_path)
+    dictionary = _zstd_dictionary(dictionary_dir, export_path) if zstandard is not None else None
+
+    index = {
+        "version": EXPORT_VERSION,
+        "compression": "zstd" if zstandard is not None else "deflate",
+        "dictionary": "zstd.dict" if dictionary is not None and portable else None,
+        "dictionary_id": dictionary.dict_id() if dictionary is not None else None,
+        "channels": [],
+        "attachments": {},
+    }
+    tmp_path = archive_path.with_suffix(".tmp")
+    pending = {}
+    with zipfile.ZipFile(tmp_path, 'w') as zf:
+        if index["dictionary"]:
+            zf.writestr(index["dictionary"], dictionary.as_bytes())
+        member_file = writer = None
+        for record in export.records(resolve=False):
+            if record["type"] == "channel":
+                if writer is not None:
+                    writer.close()
+                    member_file.close()
+                member = f"channels/{len(index['channels'])}_{record['id']}.jsonl"
+                if zstandard is not None:
+                    member += ".zst"
+                    member_file = zf.open(_zip_info(member, zipfile.ZIP_STORED), 'w', force_zip64=True)
+                    writer = zstandard.ZstdCompressor(level=19, dict_data=dictionary).stream_writer(member_file, closefd=False)
+                else:
+                    member_file = writer = zf.open(_zip_info(member, zipfile.ZIP_DEFLATED), 'w', force_zip64=True)
+                index["channels"].append({"id": record["id"], "name": record["name"], "member": member})
+            writer.write(json.dumps(record, separators=(",", ":")).encode() + b"\n")
+            if record["type"] == "message":
+                _collect_attachments(export, record, index["attachments"], pending)
+        if writer is not None:
+            writer.close()
+            member_file.close()
+
+        # Only one member can be written at a time, so attachments are added after the channels
+        for member, (path, filename) in pending.items():
+            compress = zipfile.ZIP_STORED if Path(filename).suffix.lower() in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+            zf.write(path, member, compress_type=compress)
+        zf.writestr(_zip_info("index.json", zipfile.ZIP_DEFLATED), json.dumps(index))
+    os.replace(tmp_path, archive_path)
+
+
+def archive_export(export_path: Path, dictionary_dir: Path | None = None, portable: bool = False) -> Path:
+    """Replaces an export with an archive of it. Blobs are left in the blob store, since other exports may use them"""
+    archive_path = export_path.with_suffix(ARCHIVE_SUFFIX)
+    pack_archive(export_path, archive_path, dictionary_dir, portable)
+    export_path.unlink()
+    shutil.rmtree(export_path.with_suffix(""), ignore_errors=True)
+    return archive_path
+
+
+def _zip_info(member: str, compress_type: int) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(member, date_time=time.localtime()[:6])
+    info.compress_type = compress_type
+    return info
+
+
+def _collect_attachments(export: LooseExport, message: dict, attachments: dict[str, str],
+                         pending: dict[str, tuple[Path, str]]):
+    for j, attachment in enumerate(message["attachments"]):
+        path = Path(export.attachment_path(message["id"], j, attachment["filename"]))
+        member = f"attachments/{path.name}"
+        if member not in pending:
+            if not path.exists():
+                continue
+            pending[member] = (path, attachment["filename"])
+        attachments[Manifest.key(message["id"], j)] = member
+
+
+SEARCH_INDEX_FILENAME = "search.sqlite3"
+
+
+class SearchIndex:
+    """SQLite FTS5 index over the messages of every exported CTF in a guild backup directory.
+    The messages table holds the metadata and the external content of the full-text table."""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY, ctf_id INTEGER NOT NULL, ctf TEXT NOT NULL, channel_id INTEGER NOT NULL,
+            channel TEXT NOT NULL, author TEXT NOT NULL, username TEXT NOT NULL, created_at TEXT NOT NULL,
+            content TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS messages_ctf ON messages (ctf_id);
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, content='messages', content_rowid='id');
+        CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END;
+    """
+
+    def __init__(self, path: Path):
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(self.SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.close()
+
+    def index_export(self, ctf_id: int, ctf: str, export: "LooseExport | ArchiveExport") -> int:
+        """Replaces the indexed messages of a CTF with the messages of its export"""
+        def rows():
+            for channel, messages in _channel_sections(export.records()):
+                for message in messages:
+                    if message["content"]:
+                        author = message["author"]
+                        yield (message["id"], ctf_id, ctf, channel["id"], channel["name"], author["nick"],
+                               author["user"], message["created_at"], message["content"])
+
+        with self.db:
+            self.db.execute("DELETE FROM messages WHERE ctf_id = ?", (ctf_id,))
+            self.db.executemany("INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows())
+            return self.db.execute("SELECT COUNT(*) FROM messages WHERE ctf_id = ?", (ctf_id,)).fetchone()[0]
+
+    @staticmethod
+    def match_expression(query: str) -> str:
+        """Quotes every term of query, so it is never parsed as FTS5 syntax. A trailing * still does a prefix search"""
+        terms = []
+        for term in query.split():
+            prefix = term.endswith("*")
+            term = term.rstrip("*")
+            if term:
+                terms.append('"' + term.replace('"', '""') + '"' + ("*" if prefix else ""))
+        return " ".join(terms)
+
+    def search(self, query: str, ctf: str | None = None, author: str | None = None, limit: int = 10) -> list[dict]:
+        """Returns the best matches for query, optionally limited to a CTF name and an author nick or username"""
+        match = self.match_expression(query)
+        if not match:
+            return []
+        sql = ("SELECT m.id, m.ctf, m.channel_id, m.channel, m.author, m.created_at, "
+               "snippet(messages_fts, 0, '**', '**', '...', 24) "
+               "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid WHERE messages_fts MATCH ?")
+        params = [match]
+        if ctf is not None:
+            sql += " AND m.ctf = ? COLLATE NOCASE"
+            params.append(ctf)
+        if author is not None:
+            sql += " AND (m.author LIKE ? OR m.username LIKE ?)"
+            params += [author, author]
+        sql += " ORDER BY rank LIMIT ?"
+        params.append(limit)
+        keys = ("id", "ctf", "channel_id", "channel", "author", "created_at", "snippet")
+        return [dict(zip(keys, row)) for row in self.db.execute(sql, params)]
+
+
+def index_export(export_path: Path) -> int:
+    """Adds an export to the search index of its guild backup directory. Returns the number of indexed messages"""
+    ctf_id, _, ctf = export_path.stem.partition("_")
+    with SearchIndex(export_path.parent / SEARCH_INDEX_FILENAME) as index, open_export(export_path) as export:
+        return index.index_export(int(ctf_id), ctf, export)
+
+
+def search_exports(guild_dir: Path, query: str, ctf: str | None = None, author: str | None = None,
+                   limit: int = 10) -> list[dict]:
+    index_path = guild_dir / SEARCH_INDEX_FILENAME
+    if not index_path.exists():
+        return []
+    with SearchIndex(index_path) as index:
+        return index.search(query, ctf, author, limit)
+
+
+def _channel_sections(records: Iterable[dict]) -> Iterator[tuple[dict, Iterator[dict]]]:
+    """Groups records into (channel, messages)"""
+    for _, group in itertools.groupby(records, key=lambda r: r["channel"] if r["type"] == "message" else r["id"]):
+        channel = next(group)
+        yield channel, group
 
 
 def split_big_message(msg: str) -> tuple[str, str]:
@@ -114,123 +982,394 @@ def split_big_message(msg: str) -> tuple[str, str]:
 
 
 FILE_LIMIT = 10_000_000
+MAX_FILES = 10
+
+
+def pack_files(sizes: dict[int, int], limit: int = FILE_LIMIT, max_files: int = MAX_FILES) -> list[list[int]]:
+    """Packs attachments (index -> size) into as few messages as possible with first fit decreasing, keeping each
+    message under the size and file count limits. All sizes must be at most limit."""
+    groups = []
+    totals = []
+    for j in sorted(sizes, key=lambda j: -sizes[j]):
+        for g, group in enumerate(groups):
+            if len(group) < max_files and totals[g] + sizes[j] <= limit:
+                group.append(j)
+                totals[g] += sizes[j]
+                break
+        else:
+            groups.append([j])
+            totals.append(sizes[j])
+    return sorted((sorted(group) for group in groups), key=lambda group: group[0])
+
+
+def _plan_attachments(export: "LooseExport | ArchiveExport", message: dict) -> tuple[dict[int, int], list[discord.Embed], list[str]]:
+    """Returns the sizes of the attachments that can be uploaded, and embeds and warnings for the skipped ones"""
+    sizes = {}
+    embeds = []
+    warnings = []
+    for j, attachment in enumerate(message['attachments']):
+        file_path = export.attachment_path(message['id'], j, attachment["filename"])
+        try:
+            file_size = export.attachment_size(message['id'], j, attachment["filename"])
+        except OSError as e:
+            embed = discord.Embed(
+                title="Attachment Skipped: Missing File",
+                description=f"**Filename:** {attachment['filename']}\n",
+                color=0xff0000
+            )
+            embeds.append(embed)
+            warnings.append(f"oserror: {e}")
+            continue
+        if file_size > FILE_LIMIT:
+            embed = discord.Embed(
+                title="Attachment Skipped: File Too Large",
+                description=f"**Filename:** {attachment['filename']}\n"
+                            f"**Path:** `{file_path}`\n"
+                            f"**Size:** {file_size / (1024 * 1024):.2f} MB",
+                color=0xff0000
+            )
+            embeds.append(embed)
+            warnings.append(f"Too big: {file_path}")
+            continue
+        sizes[j] = file_size
+    return sizes, embeds, warnings
 
 
-async def reexport_ctf(export_channel: discord.TextChannel, ctf_export: dict, attachment_dir: Path):
-    if not ctf_export["channels"] or not ctf_export["channels"][0]['messages']:
-        return  # Empty. Let's just skip
+def plan_channel(export: "LooseExport | ArchiveExport", channel: dict, messages: Iterable[dict]) -> Iterator[dict]:
+    """Plans the webhook messages for re-exporting a channel. Runs of simple messages from the same author are
+    joined greedily into messages of up to 2000 characters, which gives the fewest messages for a run. Messages
+    with embeds, attachments or threads are sent on their own, but may start with the preceding run."""
+    pending = None
 
-    name = ctf_export["channels"][0]["name"]
+    def call(author: dict, content: str, message: dict | None = None, **kwargs) -> dict:
+        return {"author": author, "content": content, "message": message, "files": [], "embeds": [], "warnings": [], **kwargs}
 
-    channel_hooks = await export_channel.webhooks()
-    if channel_hooks:
-        hook = channel_hooks[0]
+    for i, message in enumerate(messages):
+        author = message['author']
+        content = message['content']
+        if len(content) > 2000:
+            if pending:
+                yield pending
+                pending = None
+            first_part, content = split_big_message(content)
+            yield call(author, first_part)
+
+        sizes, skipped, warnings = _plan_attachments(export, message)
+        embeds = [discord.Embed.from_dict(e) for e in message["embeds"]] + skipped
+
+        if content and not embeds and not sizes and 'thread' not in message:
+            if pending and pending["author"]["id"] == author['id'] and len(pending["content"]) + 1 + len(content) <= 2000:
+                pending["content"] += "\n" + content
+            else:
+                if pending:
+                    yield pending
+                pending = call(author, content)
+        elif content or embeds or sizes:
+            if pending and pending["author"]["id"] == author['id'] and len(pending["content"]) + 1 + len(content) <= 2000:
+                content = pending["content"] + "\n" + content
+            elif pending:
+                yield pending
+            pending = None
+            # Attachments that don't fit in one message are uploaded in the following messages
+            file_groups = pack_files(sizes) or [[]]
+            yield call(author, content, message, files=file_groups[0], embeds=embeds, warnings=warnings,
+                       thread=message.get('thread'))
+            for group in file_groups[1:]:
+                yield call(author, "", message, files=group)
+        elif i == 0 and channel.get('thread_parent'):
+            if pending:
+                yield pending
+                pending = None
+            yield call(author, "", link=True)
+    if pending:
+        yield pending
+
+
+def count_planned_messages(export_path: Path) -> int:
+    """The number of webhook messages a re-export of export_path will send"""
+    with open_export(export_path) as export:
+        return sum(sum(1 for _ in plan_channel(export, channel, messages))
+                   for channel, messages in _channel_sections(export.records()))
+
+
+async def _send_with_files(pool: "WebhookPool", export: "LooseExport | ArchiveExport", message: dict | None,
+                           group: list[int], **kwargs) -> discord.WebhookMessage:
+    """Opens the attachments of a message just before sending them, and closes them right after"""
+    with contextlib.ExitStack() as stack:
+        files = []
+        for j in group:
+            filename = message['attachments'][j]["filename"]
+            f, _ = export.open_attachment(message['id'], j, filename)
+            stack.enter_context(f)
+            files.append(discord.File(f, filename=filename))
+        return await pool.send(files=files, **kwargs)
+
+
+class WebhookPool:
+    """Sends re-exported messages through several webhooks of the export channel in turn, so the rate limit of a
+    single webhook is not the bottleneck. Messages are still sent one at a time, since Discord orders them by arrival."""
+
+    def __init__(self, hooks: list[discord.Webhook]):
+        self.hooks = hooks
+        self.next = 0
+        self.sent = 0
+        self.started = time.perf_counter()
+
+    @classmethod
+    async def create(cls, export_channel: discord.TextChannel, size: int) -> "WebhookPool":
+        hooks = [hook for hook in await export_channel.webhooks() if hook.token]
+        while len(hooks) < size:
+            try:
+                hooks.append(await export_channel.create_webhook(name='PsyBot', reason='Exporting'))
+            except discord.HTTPException:
+                # Maximum number of webhooks reached
+                if not hooks:
+                    raise
+                break
+        return cls(hooks)
+
+    async def send(self, **kwargs) -> discord.WebhookMessage:
+        hook = self.hooks[self.next]
+        self.next = (self.next + 1) % len(self.hooks)
+        msg = await hook.send(**kwargs, wait=True)
+        self.sent += 1
+        return msg
+
+    async def edit(self, webhook_id: int, message_id: int, **kwargs):
+        hook = discord.utils.get(self.hooks, id=webhook_id)
+        if hook is None:
+            logging.warning(f"Re-export: webhook {webhook_id} is no longer available, can't edit message {message_id}")
+            return
+        await hook.edit_message(message_id, **kwargs)
+
+    @property
+    def rate(self) -> float:
+        elapsed = time.perf_counter() - self.started
+        return self.sent / elapsed if elapsed > 0 else 0.0
+
+
+class ReexportJournal:
+    """Progress of a re-export, stored next to the export as <export>.reexport.json, so that an interrupted
+    re-export can continue in the same thread. call_index is the first planned webhook message (see plan_channel)
+    in the current channel that has not been sent yet."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.thread_id = None
+        self.channel_index = 0
+        self.header_sent = False
+        self.call_index = 0
+        self.thread_starters: dict[int, dict] = {}
+        self.headers: list[dict] = []
+
+    @staticmethod
+    def path_for(export_path: Path) -> Path:
+        return export_path.with_name(export_path.name + ".reexport.json")
+
+    @classmethod
+    def load(cls, export_path: Path) -> "ReexportJournal":
+        journal = cls(cls.path_for(export_path))
+        try:
+            with open(journal.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return journal
+        journal.thread_id = data["thread_id"]
+        journal.channel_index = data["channel_index"]
+        journal.header_sent = data["header_sent"]
+        journal.call_index = data["call_index"]
+        journal.thread_starters = {int(k): v for k, v in data["thread_starters"].items()}
+        journal.headers = data["headers"]
+        return journal
+
+    def save(self):
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                "thread_id": self.thread_id,
+                "channel_index": self.channel_index,
+                "header_sent": self.header_sent,
+                "call_index": self.call_index,
+                "thread_starters": self.thread_starters,
+                "headers": self.headers,
+            }, f)
+        os.replace(tmp_path, self.path)
+
+    def delete(self):
+        self.path.unlink(missing_ok=True)
+
+    async def commit(self, **progress):
+        for key, value in progress.items():
+            setattr(self, key, value)
+        await asyncio.to_thread(self.save)
+
+
+async def reexport_ctf(export_channel: discord.TextChannel, export_path: Path, resume: bool = False) -> WebhookPool | None:
+    """Re-exports a CTF into a new thread in export_channel. With resume, an interrupted re-export of the same
+    export continues where it stopped. Returns the webhook pool, which has the number of sent messages and the
+    achieved rate, or None if the export is empty"""
+    if resume:
+        journal = ReexportJournal.load(export_path)
     else:
-        hook = await export_channel.create_webhook(name='PsyBot', reason='Exporting')
+        journal = ReexportJournal(ReexportJournal.path_for(export_path))
+    with open_export(export_path) as export:
+        pool = await _reexport(export_channel, export, journal)
+    await asyncio.to_thread(journal.delete)
+    return pool
+
+
+async def _reexport(export_channel: discord.TextChannel, export: LooseExport | ArchiveExport,
+                    journal: ReexportJournal) -> WebhookPool | None:
+    records = export.records()
+    first_records = list(itertools.islice(records, 2))
+    if len(first_records) < 2 or first_records[1]["type"] != "message":
+        return None  # Empty. Let's just skip
+    records = itertools.chain(first_records, records)
+
+    name = first_records[0]["name"]
 
-    # Get first message timestamp
+    pool = await WebhookPool.create(export_channel, config.reexport_webhooks)
 
-    start_time = int(dateutil_parser.parse(ctf_export["channels"][0]['messages'][0]["created_at"]).timestamp())
+    thread = None
+    if journal.thread_id is not None:
+        try:
+            thread = await export_channel.guild.fetch_channel(journal.thread_id)
+            logging.info(f"Re-export: resuming {name} at channel {journal.channel_index}, message {journal.call_index}")
+        except discord.NotFound:
+            logging.warning(f"Re-export: thread of {name} was deleted, starting over")
+            journal = ReexportJournal(journal.path)
 
-    start_message = await export_channel.send(f'Archive of {name} <t:{start_time}>')
-    thread = await export_channel.create_thread(name=name, message=start_message, reason=f"Re-exporting {name}")
+    if thread is None:
+        # Get first message timestamp
+        start_time = int(dateutil_parser.parse(first_records[1]["created_at"]).timestamp())
 
-    thread_starters = {}
-    channel_headers = []
+        start_message = await export_channel.send(f'Archive of {name} <t:{start_time}>')
+        thread = await export_channel.create_thread(name=name, message=start_message, reason=f"Re-exporting {name}")
+        await journal.commit(thread_id=thread.id)
 
     # TODO: Fix jump_urls and intra-ctf channel links. There's a chance that it requires us to edit a hook message later, since the target message doesn't exist yet. Also need to ensure size doesn't exceed 2000
 
-    for channel in ctf_export["channels"]:
+    for channel_index, (channel, messages) in enumerate(_channel_sections(records)):
+        if channel_index < journal.channel_index:
+            continue
 
-        header_content = '# {}{}'.format('Thread: ' if channel.get('thread_parent') else '', channel['name'])
-        header_message = await thread.send(content=header_content, silent=True)
-        channel_headers.append(header_message)
+        if not journal.header_sent:
+            header_content = '# {}{}'.format('Thread: ' if channel.get('thread_parent') else '', channel['name'])
+            header_message = await thread.send(content=header_content, silent=True)
+            journal.headers.append({"id": header_message.id, "name": channel['name'], "thread": bool(channel.get('thread_parent'))})
+            await journal.commit(header_sent=True)
 
-        last_content = ""
-        for i, message in enumerate(channel["messages"]):
-            author = message['author']
+        for call_index, call in enumerate(plan_channel(export, channel, messages)):
+            if call_index < journal.call_index:
+                continue
+            for warning in call["warnings"]:
+                logging.warning(warning)
+            author = call['author']
             author_name = author['nick'] if author.get('nick') not in (None, '<Unknown>') else author['user']
             author_avatar = 'https://cdn.discordapp.com/avatars/{}/{}.png'.format(author['id'], author['avatar'])
-            content = message['content']
-            if len(content) > 2000:
-                assert not last_content  # Having last_content at this point should be impossible
-                first_part, content = split_big_message(content)
-                msg = await hook.send(content=first_part, username=author_name, avatar_url=author_avatar, thread=thread,
-                                      silent=True, allowed_mentions=discord.AllowedMentions.none(), wait=True)
-                logging.warning(msg.jump_url)
-
-            embeds = [discord.Embed.from_dict(i) for i in message["embeds"]]
-
-            files = []
-            total_size = 0
-            # TODO: If all the files are below 10 MB and just the sum of them is above, then we can just upload them in the following messages.
-            for j, attachment in enumerate(message['attachments']):
-                file_path = str(attachment_dir / "{}{}_{}".format(message['id'], j, attachment["filename"].replace('/','')))
-                try:
-                    f = open(file_path, 'rb')
-                    f.seek(0, 2)
-                    file_size = f.tell()
-                    if file_size + total_size > FILE_LIMIT:
-                        embed = discord.Embed(
-                            title="Attachment Skipped: File Too Large",
-                            description=f"**Filename:** {attachment['filename']}\n"
-                                        f"**Path:** `{file_path}`\n"
-                                        f"**Size:** {file_size / (1024 * 1024):.2f} MB",
-                            color=0xff0000
-                        )
-                        embeds.append(embed)
-                        logging.warning("Too big:", file_path)
-                        f.close()
-                        continue
-                    f.seek(0)
-                    files.append(discord.File(f, filename=attachment["filename"]))
-                    total_size += file_size
-                except OSError as e:
-                    embed = discord.Embed(
-                        title="Attachment Skipped: Missing File",
-                        description=f"**Filename:** {attachment['filename']}\n",
-                        color=0xff0000
-                    )
-                    embeds.append(embed)
-                    logging.warning("oserror:", e)
-
-            if content and not embeds and not files and 'thread' not in message and i + 1 < len(channel["messages"]) and \
-                    channel["messages"][i + 1]['author']['id'] == author['id'] and len(content) + len(
-                    last_content) + len(channel["messages"][i + 1]['content']) < 2000:
-                # This is a simple message (no attachments or embeds), so we can prepend it to the next message
-                last_content += content + "\n"
-            elif content or embeds or files:
-                msg = await hook.send(content=last_content + content, username=author_name, avatar_url=author_avatar,
-                                      files=files, embeds=embeds, thread=thread, silent=True,
-                                      allowed_mentions=discord.AllowedMentions.none(), wait=True)
-                last_content = ""
-                if 'thread' in message and len(content) < 2000 - 90:
-                    thread_starters[message['thread']] = msg
-            elif message == channel["messages"][0] and channel.get('thread_parent'):
-                other = thread_starters.get(channel.get('id'))
+
+            if call.get("link"):
+                other = journal.thread_starters.get(channel['id'])
                 if not other:
+                    await journal.commit(call_index=call_index + 1)
                     continue
                 # Link thread starter and the thread
-                msg = await hook.send(content=other.content + '\n' + other.jump_url, username=author_name,
+                msg = await pool.send(content=other['content'] + '\n' + other['jump_url'], username=author_name,
                                       avatar_url=author_avatar, thread=thread, silent=True,
-                                      allowed_mentions=discord.AllowedMentions.none(), wait=True)
-                await other.edit(content=other.content + '\n' + msg.jump_url)
+                                      allowed_mentions=discord.AllowedMentions.none())
+                await journal.commit(call_index=call_index + 1)
+                await pool.edit(other['webhook_id'], other['id'], content=other['content'] + '\n' + msg.jump_url, thread=thread)
+                continue
+
+            msg = await _send_with_files(pool, export, call["message"], call["files"], content=call["content"] or None,
+                                         username=author_name, avatar_url=author_avatar, embeds=call["embeds"],
+                                         thread=thread, silent=True, allowed_mentions=discord.AllowedMentions.none())
+            if call.get("thread") and len(call["content"]) < 2000 - 90:
+                journal.thread_starters[call["thread"]] = {
+                    "webhook_id": msg.webhook_id, "id": msg.id, "content": msg.content, "jump_url": msg.jump_url
+                }
+            await journal.commit(call_index=call_index + 1)
         await thread.send(content='.\n' * 50, silent=True)
+        await journal.commit(channel_index=channel_index + 1, header_sent=False, call_index=0)
+
+    channel_headers = [(header, thread.get_partial_message(header["id"])) for header in journal.headers]
     try:
-        for hdr in channel_headers:
+        for _, hdr in channel_headers:
             await hdr.pin()
     except Exception:
         # Limit of 50 pins reached
         pass
     link_message = ""
-    for channel, hdr in zip(ctf_export["channels"], channel_headers):
-        s = "**{}{}:** {}\n".format('Thread: ' if channel.get('thread_parent') else '', channel['name'], hdr.jump_url)
+    for header, hdr in channel_headers:
+        s = "**{}{}:** {}\n".format('Thread: ' if header['thread'] else '', header['name'], hdr.jump_url)
         if len(link_message) + len(s) > 2000:
             await thread.send(content=link_message.rstrip(), silent=True)
             link_message = ""
         link_message += s
     if link_message:
         await thread.send(content=link_message.rstrip(), silent=True)
+    logging.info(f"Re-export: sent {pool.sent} messages through {len(pool.hooks)} webhooks ({pool.rate:.2f} messages/s)")
+    return pool
+
+
+def ctfs_in_category(category: discord.CategoryChannel) -> tuple[list[tuple[discord.TextChannel, list[discord.TextChannel]]],
+                                                                  list[discord.TextChannel]]:
+    """Finds the CTFs with a main channel in category, and their challenge channels, for when the database is not
+    available. Challenge channels are named <ctf>-<challenge> or <ctf>-<category>-<challenge>, so each belongs to the
+    CTF with the longest matching name. Main channels whose name is shared with another channel (e.g. a yearly CTF)
+    cannot be told apart, and are returned separately instead."""
+    names = collections.Counter(channel.name for channel in category.guild.text_channels)
+    mains = {channel.id: channel for channel in category.text_channels}
+    ctfs = {main_id: (main, []) for main_id, main in mains.items() if names[main.name] == 1}
+    ambiguous = [main for main in mains.values() if names[main.name] > 1]
+    by_length = sorted(mains.values(), key=lambda main: -len(main.name))
+    for channel in category.guild.text_channels:
+        if channel.id in mains:
+            continue
+        for main in by_length:
+            if channel.name.startswith(main.name + "-"):
+                if main.id in ctfs:
+                    ctfs[main.id][1].append(channel)
+                break
+    return list(ctfs.values()), ambiguous
+
+
+async def export_batch(ctfs: list[tuple[discord.TextChannel, list[discord.TextChannel]]], backups_dir: Path,
+                       export_channel: discord.TextChannel | None = None, workers: int = 2, archive: bool = False,
+                       dictionary_dir: Path | None = None) -> list[dict]:
+    """Exports several CTFs, at most workers at a time, and re-exports them to export_channel if given.
+    CTFs that already have a backup are skipped. Returns a report entry for each CTF."""
+    semaphore = asyncio.Semaphore(max(1, workers))
+
+    async def export_ctf(main: discord.TextChannel, challenges: list[discord.TextChannel]) -> dict:
+        stem = f"{main.id}_{main.name}"
+        guild_dir = backups_dir / str(main.guild.id)
+        entry = {"ctf": main.name, "channel_id": main.id}
+        if existing := find_export(guild_dir, stem):
+            return {**entry, "status": "skipped", "path": str(existing)}
+
+        async with semaphore:
+            logging.info(f"Batch: exporting {main.name}")
+            started = time.perf_counter()
+            try:
+                attachment_dir = guild_dir / stem
+                attachment_dir.mkdir(parents=True, exist_ok=True)
+                export_path = guild_dir / f"{stem}.jsonl"
+                entry["messages"] = await export_channels([main, *challenges], attachment_dir, export_path)
+                await asyncio.to_thread(index_export, export_path)
+                if archive:
+                    export_path = await asyncio.to_thread(archive_export, export_path, dictionary_dir)
+                entry.update(status="exported", path=str(export_path), channels=1 + len(challenges))
+                if export_channel is not None:
+                    pool = await reexport_ctf(export_channel, export_path)
+                    entry["reexported"] = pool.sent if pool else 0
+            except Exception as e:
+                logging.exception(f"Batch: failed to export {main.name}")
+                entry.update(status="failed", error=str(e))
+            entry["seconds"] = round(time.perf_counter() - started, 1)
+            return entry
+
+    return list(await asyncio.gather(*(export_ctf(main, challenges) for main, challenges in ctfs)))
 
 
 # Allow running this file standalone
@@ -238,18 +1377,102 @@ if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description='Export a CTF')
     parser.add_argument('--channels', type=Path, help='Path to file containing newline-separated channel names or IDs to export')
-    parser.add_argument('--json', type=Path, help='JSON file to re-export directly')
-    parser.add_argument('--export', type=int, required=True, help='ID of channel to export messages to')
+    parser.add_argument('--json', type=Path, help=f'Export file (.jsonl, {ARCHIVE_SUFFIX}, or .json for old exports) to re-export directly')
+    parser.add_argument('--category', type=str, help='Name or ID of a category (e.g. ARCHIVED CTFS) to export every CTF from')
+    parser.add_argument('--ctfs', action='store_true', help='Export every CTF in the database (requires MongoDB settings)')
+    parser.add_argument('--export', type=int, help='ID of channel to export messages to')
+    parser.add_argument('--convert', type=Path, help='Convert an old .json or .jsonl export to the current format and exit')
+    parser.add_argument('--reindex', type=Path, help='Add every export in a guild backup directory to its search index and exit')
+    parser.add_argument('--incremental', action='store_true', help='Only add new messages to an existing export of --channels, without re-exporting it')
+    parser.add_argument('--restart', action='store_true', help='Start the re-export of --json over instead of continuing an interrupted one')
+    parser.add_argument('--archive', action='store_true', help=f'Pack the export into a compressed {ARCHIVE_SUFFIX} file')
+    parser.add_argument('--portable', action='store_true', help='Store a copy of the zstd dictionary in the archive, so it can be read outside the backups directory')
+    parser.add_argument('--train-dictionary', action='store_true', help='Train a new zstd dictionary for archives on all exports in --dir and exit')
     parser.add_argument('--dir', type=Path, default=Path('backups'), help='Path to backups directory')
+    parser.add_argument('--workers', type=int, default=2, help='Number of CTFs to export at once with --category or --ctfs')
+    parser.add_argument('--no-reexport', action='store_true', help='Only back up the CTFs from --category or --ctfs')
+    parser.add_argument('--report', type=Path, help='Where to write the report of --category or --ctfs. Defaults to the guild backup directory')
     parser.add_argument('--token', type=str, help='Bot token. If not provided, it is expected in BOT_TOKEN env or in stdin')
 
     args = parser.parse_args()
 
-    if True ^ (args.channels is None) ^ (args.json is None):
-        raise Exception("Only one of --channels or --json can be provided")
+    if args.convert:
+        logging.basicConfig(level=logging.INFO)
+        logging.info(f"Converted to {convert_export(args.convert)}")
+        raise SystemExit(0)
+    if args.train_dictionary:
+        logging.basicConfig(level=logging.INFO)
+        if zstandard is None:
+            parser.error("the zstandard package is required to train a dictionary")
+        dictionary = train_dictionary(Path(args.dir))
+        logging.info(f"Trained dictionary {dictionary.dict_id()}" if dictionary else "Not enough samples to train a dictionary")
+        raise SystemExit(0)
+    if args.reindex:
+        logging.basicConfig(level=logging.INFO)
+        stems = {path.name.split(".")[0] for path in args.reindex.iterdir() if path.is_file() and path.name[0].isdigit()
+                 and path.suffix in (ARCHIVE_SUFFIX, ".jsonl", ".json") and not path.name.endswith(".reexport.json")}
+        for stem in sorted(stems):
+            if export_path := find_export(args.reindex, stem):
+                logging.info(f"Indexed {index_export(export_path)} messages from {export_path.name}")
+        raise SystemExit(0)
+    if args.export is None:
+        parser.error("the following arguments are required: --export")
+
+    if [args.channels, args.json, args.category, args.ctfs or None].count(None) != 3:
+        raise Exception("Exactly one of --channels, --json, --category or --ctfs must be provided")
 
     bot_token = args.token or os.environ.get("BOT_TOKEN") or input("Bot token: ")
 
+    def ctfs_from_db(guild: discord.Guild, category: discord.CategoryChannel | None = None) -> list[tuple[discord.TextChannel, list[discord.TextChannel]]]:
+        from psybot.models.ctf import Ctf
+        from psybot.models.challenge import Challenge
+
+        ctfs = []
+        for ctf in Ctf.objects():
+            main = guild.get_channel(ctf.channel_id)
+            if main and (category is None or main.category_id == category.id):
+                challenges = [channel for chall in Challenge.objects(ctf=ctf) if (channel := guild.get_channel(chall.channel_id))]
+                ctfs.append((main, challenges))
+        return ctfs
+
+    async def run_batch(export_channel: discord.TextChannel):
+        guild = export_channel.guild
+        ambiguous = []
+        if args.ctfs:
+            from psybot.database import run_db
+            ctfs = await run_db(ctfs_from_db, guild)
+        else:
+            category = guild.get_channel(int(args.category)) if args.category.isdigit() else \
+                discord.utils.get(guild.categories, name=args.category)
+            if not isinstance(category, discord.CategoryChannel):
+                raise Exception(f"Unknown category {args.category}")
+            # The database knows the challenge channels of each CTF by id, even when CTF names are reused
+            ctfs = None
+            try:
+                from pymongo.errors import PyMongoError
+                from psybot.database import run_db
+            except ImportError as e:
+                logging.warning(f"Matching challenge channels by name, since the database is not available: {e}")
+            else:
+                try:
+                    ctfs = await run_db(ctfs_from_db, guild, category)
+                except PyMongoError as e:
+                    logging.warning(f"Matching challenge channels by name, since the database is not available: {e}")
+            if ctfs is None:
+                ctfs, ambiguous = ctfs_in_category(category)
+
+        report = await export_batch(ctfs, Path(args.dir), None if args.no_reexport else export_channel, args.workers,
+                                    args.archive, Path(args.dir))
+        report += [{"ctf": main.name, "channel_id": main.id, "status": "failed",
+                    "error": "Another channel has the same name, so its challenge channels cannot be matched by name"}
+                   for main in ambiguous]
+        report_path = args.report or Path(args.dir) / str(guild.id) / "batch-report.json"
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        statuses = [entry["status"] for entry in report]
+        logging.info(f"Batch done: {statuses.count('exported')} exported, {statuses.count('skipped')} skipped, "
+                     f"{statuses.count('failed')} failed. Report written to {report_path}")
+
     logging.basicConfig(level=logging.INFO)
     intents = discord.Intents.all()
     client = discord.Client(intents=intents)
@@ -261,9 +1484,15 @@ if __name__ == '__main__':
         export_channel = client.get_channel(args.export)
         guild = export_channel.guild
 
+        if args.category or args.ctfs:
+            await run_batch(export_channel)
+            await client.close()
+            return
+
+        resume = False
         if args.json:
-            ctf_export = json.load(open(args.json, 'r'))
-            attachment_dir = Path(str(args.json).replace(".json",""))
+            export_path = args.json
+            resume = not args.restart
         else:
             channels: list[discord.TextChannel] = []
             for line in open(args.channels, 'r').readlines():
@@ -287,17 +1516,21 @@ if __name__ == '__main__':
             except OSError:
                 logging.warning(f"Failed to create directory {attachment_dir}")
 
-            ctf_export = await export_channels(channels, attachment_dir)
-
-            filepath = attachment_dir.parent / f"{channels[0].id}_{channels[0].name}.json"
-
-            try:
-                with open(filepath, 'w') as f:
-                    f.write(json.dumps(ctf_export, separators=(",", ":")))
-            except FileNotFoundError:
-                logging.warning(f"Failed to create JSON export file")
+            export_path = attachment_dir.parent / f"{channels[0].id}_{channels[0].name}.jsonl"
+            if args.incremental and (existing := find_export(attachment_dir.parent, export_path.stem)) and \
+                    existing.suffix == ARCHIVE_SUFFIX:
+                raise Exception(f"{existing} has been archived and cannot be updated incrementally")
+            new_messages = await export_channels(channels, attachment_dir, export_path, incremental=args.incremental)
+            await asyncio.to_thread(index_export, export_path)
+            if args.incremental:
+                logging.info(f"Export updated with {new_messages} new messages")
+                await client.close()
+                return
+            if args.archive:
+                export_path = await asyncio.to_thread(archive_export, export_path, Path(args.dir), args.portable)
 
-        await reexport_ctf(export_channel, ctf_export, attachment_dir)
+        logging.info(f"Re-exporting {count_planned_messages(export_path)} messages")
+        await reexport_ctf(export_channel, export_path, resume=resume)
         logging.info("Export done!")
         await client.close()
 
@@ -105,7 +105,7 @@ async def note(interaction: discord.Interaction, type: str = "modal"):
     elif type == "doc":
         if interaction.guild is None:
             raise app_commands.AppCommandError("HedgeDoc notes are only available in a guild")
-        settings = get_settings(interaction.guild)
+        settings = await get_settings(interaction.guild)
         if settings.hedgedoc_url is None:
             raise app_commands.AppCommandError("HedgeDoc has not been set up in this guild")
 
@@ -3,7 +3,10 @@ import discord
 from discord import app_commands
 from mongoengine import ValidationError
 
+from psybot import repository
 from psybot.utils import is_team_admin, get_settings, MAX_CHANNELS
+from psybot.modules.challenge import work_message_scheduler
+from psybot.modules.ctftime import ctftime_http
 
 
 async def check_role(guild: discord.Guild, value: str):
@@ -53,7 +56,7 @@ class PsybotCommands(app_commands.Group):
     @app_commands.choices(key=[app_commands.Choice(name=name, value=name) for name in SETTINGS_TYPES.keys()])
     @app_commands.check(is_team_admin)
     async def set(self, interaction: discord.Interaction, key: str, value: str):
-        settings = get_settings(interaction.guild)
+        settings = await get_settings(interaction.guild)
         if key not in SETTINGS_TYPES:
             raise app_commands.AppCommandError("Invalid key")
         typ = SETTINGS_TYPES[key]
@@ -85,7 +88,7 @@ class PsybotCommands(app_commands.Group):
             raise app_commands.AppCommandError("Invalid key")
 
         try:
-            settings.save()
+            await repository.save_settings(settings)
         except ValidationError:
             raise app_commands.AppCommandError("Invalid value")
 
@@ -96,7 +99,7 @@ class PsybotCommands(app_commands.Group):
     @app_commands.guild_only
     @app_commands.check(is_team_admin)
     async def info(self, interaction: discord.Interaction):
-        settings = get_settings(interaction.guild)
+        settings = await get_settings(interaction.guild)
         channel_count = len(interaction.guild.channels)
 
         response = f"Channels: {channel_count}/{MAX_CHANNELS}\n\n**Settings:**"
@@ -116,6 +119,17 @@ class PsybotCommands(app_commands.Group):
 
         await interaction.response.send_message(response, ephemeral=True)
 
+    @app_commands.command(description="Show bot cache statistics")
+    @app_commands.guild_only
+    @app_commands.check(is_team_admin)
+    async def stats(self, interaction: discord.Interaction):
+        cache = repository.settings_cache
+        response = f"**Settings cache:** {cache.hits} hits, {cache.misses} misses"
+        scheduler = work_message_scheduler
+        response += f"\n**Work messages:** {scheduler.edited} edits for {scheduler.requested} updates ({scheduler.saved} saved)"
+        response += f"\n**CTFtime cache:** {ctftime_http.hits} hits, {ctftime_http.misses} misses, {ctftime_http.revalidated} revalidated"
+        await interaction.response.send_message(response, ephemeral=True)
+
 
 def add_commands(tree: app_commands.CommandTree, guild: discord.Object | None):
     tree.add_command(PsybotCommands(name="psybot"), guild=guild)
@@ -0,0 +1,369 @@
+import sys
+import time
+import heapq
+import bisect
+import logging
+
+from bson import ObjectId
+from mongoengine import Document
+from pymongo import ReturnDocument
+
+from psybot.config import config
+from psybot.database import db, run_db
+from psybot.models.backup_category import BackupCategory
+from psybot.models.challenge import Challenge, Working
+from psybot.models.ctf import Ctf
+from psybot.models.ctf_category import CtfCategory
+from psybot.models.guild_settings import GuildSettings
+
+
+MODELS = [BackupCategory, Challenge, Ctf, CtfCategory, GuildSettings]
+
+
+async def ping():
+    await run_db(db.command, "ping")
+
+
+def _hot_queries() -> dict:
+    ctf_id = ObjectId()
+    return {
+        "ctf by channel": Ctf.objects(channel_id=0),
+        "challenge by channel": Challenge.objects(channel_id=0),
+        "challenges by ctf": Challenge.objects(ctf=ctf_id),
+        "unsolved challenges by ctf": Challenge.objects(ctf=ctf_id, solved=False),
+        "challenge by name": Challenge.objects(name="", category=None, ctf=ctf_id),
+        "working demotion": Challenge.objects(ctf=ctf_id, id__ne=ctf_id, working__match={'user': 0, 'value': 1}),
+        "categories by guild": CtfCategory.objects(guild_id=0),
+        "category by name": CtfCategory.objects(name="", guild_id=0),
+        "backup category by id": BackupCategory.objects(category_id=0),
+        "settings by guild": GuildSettings.objects(guild_id=0),
+    }
+
+
+def _plan_stages(plan) -> set[str]:
+    stages = set()
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.add(plan['stage'])
+        for value in plan.values():
+            stages |= _plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            stages |= _plan_stages(value)
+    return stages
+
+
+def check_query_plans() -> list[str]:
+    """Returns the hot queries whose winning plan is a collection scan"""
+    return [name for name, query in _hot_queries().items()
+            if 'COLLSCAN' in _plan_stages(query.explain()['queryPlanner']['winningPlan'])]
+
+
+def _ensure_indexes() -> list[str]:
+    for model in MODELS:
+        model.ensure_indexes()
+    return check_query_plans()
+
+
+async def ensure_indexes():
+    for name in await run_db(_ensure_indexes):
+        logging.error(f"Query \"{name}\" does not use an index")
+
+
+class ChannelIndex:
+    """Maps channel ids to their Ctf or Challenge, so most lookups don't need a database round trip"""
+
+    def __init__(self):
+        self.ctfs: dict[int, Ctf] = {}
+        self.challenges: dict[int, Challenge] = {}
+
+    def add(self, document: Ctf | Challenge) -> Ctf | Challenge:
+        if isinstance(document, Ctf):
+            return self.ctfs.setdefault(document.channel_id, document)
+        existing = self.challenges.get(document.channel_id)
+        if existing is not None:
+            return existing
+        # Challenges share the indexed CTF instance, so changes like archiving are seen everywhere
+        ctf_db = self.ctfs.setdefault(document.ctf.channel_id, document.ctf)
+        if document.ctf is not ctf_db:
+            document.ctf = ctf_db
+        self.challenges[document.channel_id] = document
+        return document
+
+    def discard(self, channel_id: int):
+        self.ctfs.pop(channel_id, None)
+        self.challenges.pop(channel_id, None)
+
+    def discard_ctf(self, ctf_db: Ctf):
+        self.ctfs.pop(ctf_db.channel_id, None)
+        for channel_id in [c for c, chall in self.challenges.items() if chall.ctf.pk == ctf_db.pk]:
+            del self.challenges[channel_id]
+
+
+channel_index = ChannelIndex()
+
+
+def _load_channel_index() -> ChannelIndex:
+    index = ChannelIndex()
+    ctfs = {ctf_db.pk: index.add(ctf_db) for ctf_db in Ctf.objects()}
+    for chall in Challenge.objects().no_dereference():
+        ctf_db = ctfs.get(chall.ctf.id)
+        if ctf_db is not None:
+            chall.ctf = ctf_db
+            index.add(chall)
+    return index
+
+
+async def warm_channel_index():
+    loaded = await run_db(_load_channel_index)
+    # Merge instead of replacing, so documents already handed out stay indexed
+    for ctf_db in loaded.ctfs.values():
+        channel_index.add(ctf_db)
+    for chall in loaded.challenges.values():
+        channel_index.add(chall)
+
+
+async def save(document: Document):
+    await run_db(document.save)
+    if isinstance(document, (Ctf, Challenge)):
+        channel_index.add(document)
+
+
+async def delete(document: Document):
+    await run_db(document.delete)
+    if isinstance(document, (Ctf, Challenge)):
+        channel_index.discard(document.channel_id)
+
+
+class SettingsCache:
+    """Per-guild GuildSettings cache. A ttl of 0 keeps entries until they are replaced."""
+
+    def __init__(self, ttl: int = 0):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: dict[int, tuple[GuildSettings, float]] = {}
+
+    def get(self, guild_id: int) -> GuildSettings | None:
+        entry = self._entries.get(guild_id)
+        if entry is not None and (not self.ttl or time.monotonic() - entry[1] < self.ttl):
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        return None
+
+    def put(self, settings: GuildSettings):
+        self._entries[settings.guild_id] = (settings, time.monotonic())
+
+    def invalidate(self, guild_id: int):
+        self._entries.pop(guild_id, None)
+
+
+settings_cache = SettingsCache(config.settings_cache_ttl)
+
+
+async def get_guild_settings(guild_id: int) -> GuildSettings | None:
+    settings = settings_cache.get(guild_id)
+    if settings is None:
+        settings = await run_db(lambda: GuildSettings.objects(guild_id=guild_id).first())
+        if settings is not None:
+            settings_cache.put(settings)
+    return settings
+
+
+async def save_settings(settings: GuildSettings):
+    try:
+        await run_db(settings.save)
+    except Exception:
+        # The cached instance may have been modified before the failed save
+        settings_cache.invalidate(settings.guild_id)
+        raise
+    settings_cache.put(settings)
+
+
+async def get_ctf(channel_id: int) -> Ctf | None:
+    ctf_db = channel_index.ctfs.get(channel_id)
+    if ctf_db is None:
+        ctf_db = await run_db(lambda: Ctf.objects(channel_id=channel_id).first())
+        if ctf_db is not None:
+            ctf_db = channel_index.add(ctf_db)
+    return ctf_db
+
+
+def _get_challenge(channel_id: int) -> Challenge | None:
+    chall_db = Challenge.objects(channel_id=channel_id).first()
+    if chall_db is not None:
+        # Dereference the CTF while still on the database thread
+        _ = chall_db.ctf
+    return chall_db
+
+
+async def get_challenge(channel_id: int) -> Challenge | None:
+    chall_db = channel_index.challenges.get(channel_id)
+    if chall_db is None:
+        chall_db = await run_db(_get_challenge, channel_id)
+        if chall_db is not None:
+            chall_db = channel_index.add(chall_db)
+    return chall_db
+
+
+def _get_challenges(ctf_db: Ctf, **filters) -> list[Challenge]:
+    challs = list(Challenge.objects(ctf=ctf_db, **filters))
+    for chall in challs:
+        # Share the already loaded CTF instead of lazily dereferencing it later
+        chall.ctf = ctf_db
+    return challs
+
+
+async def get_challenges(ctf_db: Ctf, **filters) -> list[Challenge]:
+    challs = await run_db(_get_challenges, ctf_db, **filters)
+    # Prefer the indexed instances, as they are the ones being kept up to date
+    return [channel_index.add(chall) for chall in challs]
+
+
+def _replace_working(chall_db: Challenge, working: list[dict]):
+    chall_db.working = [Working(user=w['user'], value=w['value']) for w in working]
+    # The database already has this state, so a later save() must not write the array back. Other changed fields
+    # (e.g. solved from /done) may still be waiting for their save
+    chall_db._changed_fields = [field for field in chall_db._changed_fields
+                                if field != 'working' and not field.startswith('working.')]
+
+
+async def set_work(chall_db: Challenge, user_id: int, value: int) -> bool:
+    """Atomically set a user's working status on a challenge. Returns False if nothing changed."""
+    if value == 0:
+        query = {'_id': chall_db.pk, 'working.user': user_id}
+        update = {'$pull': {'working': {'user': user_id}}}
+    else:
+        entry = {'user': user_id, 'value': value}
+        working = {'$ifNull': ['$working', []]}
+        query = {'_id': chall_db.pk, 'working': {'$not': {'$elemMatch': entry}}}
+        # Replace the user's entry in place if it exists, otherwise append it
+        update = [{'$set': {'working': {'$cond': [
+            {'$in': [user_id, {'$map': {'input': working, 'in': '$$this.user'}}]},
+            {'$map': {'input': working, 'in': {'$cond': [{'$eq': ['$$this.user', user_id]}, entry, '$$this']}}},
+            {'$concatArrays': [working, [entry]]}
+        ]}}}]
+    doc = await run_db(Challenge._get_collection().find_one_and_update, query, update,
+                       projection={'working': True}, return_document=ReturnDocument.AFTER)
+    if doc is None:
+        return False
+    _replace_working(chall_db, doc.get('working', []))
+    return True
+
+
+async def demote_work(ctf_db: Ctf, user_id: int, exclude: Challenge) -> list[Challenge]:
+    """Change a user's "Working" status to "Has Worked" on all other challenges in the CTF.
+    Returns the challenges that changed."""
+    await run_db(lambda: Challenge.objects(ctf=ctf_db, id__ne=exclude.pk, working__match={'user': user_id, 'value': 1})
+                 .update(set__working__S__value=2))
+    changed = []
+    for chall in channel_index.challenges.values():
+        if chall is exclude or chall.ctf.pk != ctf_db.pk:
+            continue
+        if any(w.user == user_id and w.value == 1 for w in chall.working):
+            _replace_working(chall, [{'user': w.user, 'value': 2 if w.user == user_id else w.value} for w in chall.working])
+            changed.append(chall)
+    return changed
+
+
+async def find_challenge(ctf_db: Ctf, name: str, category: str | None) -> Challenge | None:
+    return await run_db(lambda: Challenge.objects(name=name, category=category, ctf=ctf_db).first())
+
+
+async def delete_ctf(ctf_db: Ctf):
+    await run_db(lambda: Challenge.objects(ctf=ctf_db).delete())
+    await run_db(ctf_db.delete)
+    channel_index.discard_ctf(ctf_db)
+
+
+class CategoryIndex:
+    """Per-guild category names kept sorted, so prefix lookups are a bisect instead of a regex query"""
+
+    def __init__(self):
+        self._counts: dict[int, dict[str, int]] = {}
+        self._names: dict[int, list[str]] = {}
+
+    def is_loaded(self, guild_id: int) -> bool:
+        return guild_id in self._counts
+
+    def load(self, guild_id: int, counts: dict[str, int]):
+        self._counts[guild_id] = counts
+        self._names[guild_id] = sorted(counts)
+
+    def contains(self, guild_id: int, name: str) -> bool:
+        return name in self._counts[guild_id]
+
+    def find(self, guild_id: int, prefix: str, limit: int) -> list[str]:
+        names, counts = self._names[guild_id], self._counts[guild_id]
+        lo = bisect.bisect_left(names, prefix)
+        hi = bisect.bisect_right(names, prefix + chr(sys.maxunicode), lo)
+        return heapq.nsmallest(limit, names[lo:hi], key=lambda name: (-counts[name], name))
+
+    def add(self, guild_id: int, name: str, count: int):
+        counts = self._counts[guild_id]
+        if name not in counts:
+            bisect.insort(self._names[guild_id], name)
+        counts[name] = count
+
+    def increment(self, guild_id: int, name: str):
+        self.add(guild_id, name, self._counts[guild_id].get(name, 0) + 1)
+
+    def remove(self, guild_id: int, name: str):
+        if self._counts[guild_id].pop(name, None) is not None:
+            names = self._names[guild_id]
+            del names[bisect.bisect_left(names, name)]
+
+
+category_index = CategoryIndex()
+
+
+async def _load_categories(guild_id: int):
+    if not category_index.is_loaded(guild_id):
+        counts = await run_db(lambda: {c.name: c.count for c in CtfCategory.objects(guild_id=guild_id)})
+        if not category_index.is_loaded(guild_id):
+            category_index.load(guild_id, counts)
+
+
+async def find_categories(guild_id: int, prefix: str, limit: int = 25) -> list[str]:
+    await _load_categories(guild_id)
+    return category_index.find(guild_id, prefix, limit)
+
+
+async def category_exists(guild_id: int, name: str) -> bool:
+    await _load_categories(guild_id)
+    return category_index.contains(guild_id, name)
+
+
+async def create_category(guild_id: int, name: str, count: int):
+    """Raises NotUniqueError if the category already exists"""
+    await _load_categories(guild_id)
+    await run_db(CtfCategory(name=name, guild_id=guild_id, count=count).save)
+    category_index.add(guild_id, name, count)
+
+
+async def increment_category(guild_id: int, name: str):
+    await _load_categories(guild_id)
+    await run_db(lambda: CtfCategory.objects(name=name, guild_id=guild_id).update_one(inc__count=1, upsert=True))
+    category_index.increment(guild_id, name)
+
+
+async def delete_category(guild_id: int, name: str) -> bool:
+    await _load_categories(guild_id)
+    deleted = await run_db(lambda: CtfCategory.objects(name=name, guild_id=guild_id).delete()) > 0
+    category_index.remove(guild_id, name)
+    return deleted
+
+
+async def get_backup_categories() -> list[BackupCategory]:
+    return await run_db(lambda: list(BackupCategory.objects()))
+
+
+async def add_backup_category(original_id: int, category_id: int, index: int) -> BackupCategory:
+    backup_category = BackupCategory(original_id=original_id, category_id=category_id, index=index)
+    await run_db(backup_category.save)
+    return backup_category
+
+
+async def delete_backup_category(category_id: int) -> bool:
+    return await run_db(lambda: BackupCategory.objects(category_id=category_id).delete()) > 0
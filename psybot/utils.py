@@ -1,103 +1,319 @@
+import bisect
+import asyncio
 import discord
 
+from typing import Awaitable, Callable
+
 from discord import app_commands
 
-from psybot.models.backup_category import BackupCategory
+from psybot import repository
 from psybot.models.guild_settings import GuildSettings
 
 
 MAX_CHANNELS = 500
 CATEGORY_MAX_CHANNELS = 50
+# Create the next backup category once a category and all its backups have fewer free slots than this
+BACKUP_CATEGORY_MARGIN = 5
 
 
-def get_category_pos(category_channel: discord.CategoryChannel, name: str):
+def _split_challenge_name(name: str) -> tuple[str, str] | None:
     if name.count("-") == 1:
-        ctf, category = name.split("-")[0], None
+        return name.split("-")[0], ''
     elif name.count("-") == 2:
         ctf, category, _ = name.split("-")
-    else:
-        # This channel doesn't have the challenge name format.
-        return (category_channel.text_channels[-1].position // 1000 + 1) * 1000
-    same_category_channel = None
-    same_ctf_channel = None
-    for channel in category_channel.text_channels:
-        if channel.name.startswith(f"{ctf}-"):
-            same_ctf_channel = channel
-        if category is None:
-            if channel.name.count("-") == 1:
-                same_category_channel = channel
-        elif channel.name.startswith(f"{ctf}-{category}-"):
-            same_category_channel = channel
-
-    if same_category_channel:
-        return same_category_channel.position
-    elif same_ctf_channel:
-        return same_ctf_channel.position + 1
-    elif category_channel.text_channels:
-        ctf_pos = category_channel.text_channels[-1].position // 1000 + 1
-        return ctf_pos * 1000
-    else:
+        return ctf, category
+    # This channel doesn't have the challenge name format.
+    return None
+
+
+class CategoryPositionIndex:
+    """The text channels of a category, kept sorted by (ctf, category, position) and (ctf, position)"""
+
+    _END = float('inf')
+
+    def __init__(self, category_channel: discord.CategoryChannel):
+        self.category_keys: list[tuple[str, str, int, int]] = []
+        self.ctf_keys: list[tuple[str, int, int]] = []
+        self.positions: list[tuple[int, int]] = []
+        self.entries: dict[int, tuple] = {}
+        for channel in category_channel.text_channels:
+            self.add(channel)
+
+    def add(self, channel: discord.TextChannel):
+        self.remove(channel.id)
+        split = _split_challenge_name(channel.name)
+        pos = (channel.position, channel.id)
+        bisect.insort(self.positions, pos)
+        if split:
+            category_key, ctf_key = (*split, *pos), (split[0], *pos)
+            bisect.insort(self.category_keys, category_key)
+            bisect.insort(self.ctf_keys, ctf_key)
+            self.entries[channel.id] = (pos, category_key, ctf_key)
+        else:
+            self.entries[channel.id] = (pos,)
+
+    def remove(self, channel_id: int):
+        entry = self.entries.pop(channel_id, None)
+        if entry is None:
+            return
+        for keys, key in zip((self.positions, self.category_keys, self.ctf_keys), entry):
+            del keys[bisect.bisect_left(keys, key)]
+
+    def insert_position(self, name: str) -> int:
+        split = _split_challenge_name(name)
+        if split is not None:
+            ctf, category = split
+            # Last channel of the same CTF and category
+            i = bisect.bisect_left(self.category_keys, (ctf, category, self._END))
+            if i > 0 and self.category_keys[i - 1][:2] == (ctf, category):
+                return self.category_keys[i - 1][2]
+            # Last channel of the same CTF
+            i = bisect.bisect_left(self.ctf_keys, (ctf, self._END))
+            if i > 0 and self.ctf_keys[i - 1][0] == ctf:
+                return self.ctf_keys[i - 1][1] + 1
+        if self.positions:
+            return (self.positions[-1][0] // 1000 + 1) * 1000
         return 0
 
 
-async def get_backup_category(original_category: discord.CategoryChannel):
-    last_backup = None
-    for cat in BackupCategory.objects(original_id=original_category.id).order_by('index'):
-        last_backup = cat
-        category = original_category.guild.get_channel(cat['category_id'])
-        if len(category.channels) < CATEGORY_MAX_CHANNELS:
-            return category
-    idx = 2 if not last_backup else last_backup['index']+1
+_position_indexes: dict[int, CategoryPositionIndex] = {}
+
+
+def get_category_pos(category_channel: discord.CategoryChannel, name: str) -> int:
+    index = _position_indexes.get(category_channel.id)
+    if index is None:
+        index = _position_indexes[category_channel.id] = CategoryPositionIndex(category_channel)
+    return index.insert_position(name)
+
+
+class CategoryCapacity:
+    """Tracks which channels are in which category, and the backup categories of each category"""
+
+    def __init__(self):
+        self.members: dict[int, set[int]] = {}
+        self.channel_category: dict[int, int] = {}
+        self.backups: dict[int, list[tuple[int, int]]] = {}
+        self.original_of: dict[int, int] = {}
+
+    def count(self, category_id: int) -> int:
+        return len(self.members.get(category_id, ()))
+
+    def is_full(self, category_id: int) -> bool:
+        return self.count(category_id) >= CATEGORY_MAX_CHANNELS
+
+    def place(self, channel_id: int, category_id: int | None):
+        self.remove(channel_id)
+        if category_id is not None:
+            self.members.setdefault(category_id, set()).add(channel_id)
+            self.channel_category[channel_id] = category_id
+
+    def remove(self, channel_id: int):
+        category_id = self.channel_category.pop(channel_id, None)
+        if category_id is not None:
+            self.members[category_id].discard(channel_id)
+
+    def add_backup(self, original_id: int, idx: int, category_id: int):
+        # on_ready runs again after a reconnect, so a backup may already be registered
+        if category_id in self.original_of:
+            original = self.original_of[category_id]
+            self.backups[original] = [b for b in self.backups[original] if b[1] != category_id]
+        bisect.insort(self.backups.setdefault(original_id, []), (idx, category_id))
+        self.original_of[category_id] = original_id
+
+    def remove_category(self, category_id: int):
+        self.members.pop(category_id, None)
+        original_id = self.original_of.pop(category_id, None)
+        if original_id is not None:
+            self.backups[original_id] = [b for b in self.backups[original_id] if b[1] != category_id]
+
+    def chain(self, original_id: int) -> list[int]:
+        return [original_id] + [category_id for _, category_id in self.backups.get(original_id, [])]
+
+    def next_index(self, original_id: int) -> int:
+        backups = self.backups.get(original_id)
+        return backups[-1][0] + 1 if backups else 2
+
+    def needs_spare(self, original_id: int, ignore: int | None = None) -> bool:
+        return all(self.count(c) >= CATEGORY_MAX_CHANNELS - BACKUP_CATEGORY_MARGIN
+                   for c in self.chain(original_id) if c != ignore)
+
+
+category_capacity = CategoryCapacity()
+_provisioning: dict[int, asyncio.Task] = {}
+
+
+async def load_category_capacity(guild: discord.Guild):
+    backups = await repository.get_backup_categories()
+    for channel in guild.channels:
+        if not isinstance(channel, discord.CategoryChannel):
+            category_capacity.place(channel.id, channel.category_id)
+    for cat in backups:
+        if guild.get_channel(cat['category_id']) is not None:
+            category_capacity.add_backup(cat['original_id'], cat['index'], cat['category_id'])
+
+
+def track_channel(channel: discord.abc.GuildChannel):
+    """Keep the category position indexes and capacities up to date when a channel is created or changed"""
+    if isinstance(channel, discord.CategoryChannel):
+        return
+    category_capacity.place(channel.id, channel.category_id)
+    for category_id, index in _position_indexes.items():
+        if category_id == channel.category_id and isinstance(channel, discord.TextChannel):
+            index.add(channel)
+        else:
+            index.remove(channel.id)
+
+
+def untrack_channel(channel: discord.abc.GuildChannel):
+    if isinstance(channel, discord.CategoryChannel):
+        _position_indexes.pop(channel.id, None)
+        category_capacity.remove_category(channel.id)
+    category_capacity.remove(channel.id)
+    for index in _position_indexes.values():
+        index.remove(channel.id)
+
+
+async def _create_backup_category(original_category: discord.CategoryChannel, idx: int) -> discord.CategoryChannel:
     new_category = await original_category.guild.create_category(f"{original_category.name} {idx}", position=original_category.position)
-    backup_category = BackupCategory(original_id=original_category.id, category_id=new_category.id, index=idx)
-    backup_category.save()
+    await repository.add_backup_category(original_category.id, new_category.id, idx)
+    category_capacity.add_backup(original_category.id, idx, new_category.id)
     return new_category
 
 
+def _provision_backup_category(original_category: discord.CategoryChannel):
+    """Create the next backup category in the background before the current ones fill up"""
+    if original_category.id in _provisioning or not category_capacity.needs_spare(original_category.id):
+        return
+    task = asyncio.create_task(_create_backup_category(original_category, category_capacity.next_index(original_category.id)))
+    _provisioning[original_category.id] = task
+    task.add_done_callback(lambda _: _provisioning.pop(original_category.id, None))
+
+
+async def get_backup_category(original_category: discord.CategoryChannel):
+    if original_category.id in _provisioning:
+        await asyncio.shield(_provisioning[original_category.id])
+    for category_id in category_capacity.chain(original_category.id)[1:]:
+        if not category_capacity.is_full(category_id):
+            return original_category.guild.get_channel(category_id)
+    return await _create_backup_category(original_category, category_capacity.next_index(original_category.id))
+
+
+async def _get_category_with_room(category: discord.CategoryChannel) -> discord.CategoryChannel:
+    _provision_backup_category(category)
+    if category_capacity.is_full(category.id):
+        return await get_backup_category(category)
+    return category
+
+
 async def free_backup_category(category: discord.CategoryChannel):
-    if len(category.channels) == 0:
-        backup_category = BackupCategory.objects(category_id=category.id).first()
-        if backup_category is not None:
-            backup_category.delete()
-            await category.delete(reason="Removing unused backup category")
+    original_id = category_capacity.original_of.get(category.id)
+    if original_id is None or category_capacity.count(category.id) > 0:
+        return
+    # Keep an empty backup category around as the spare if the others are close to full
+    if category_capacity.needs_spare(original_id, ignore=category.id):
+        return
+    category_capacity.remove_category(category.id)
+    await repository.delete_backup_category(category.id)
+    await category.delete(reason="Removing unused backup category")
 
 
 async def delete_channel(channel: discord.TextChannel):
     original_category = channel.category
     await channel.delete(reason="Deleted CTF channels")
-    await free_backup_category(original_category)
+    untrack_channel(channel)
+    if original_category is not None:
+        await free_backup_category(original_category)
 
 
 async def create_channel(name: str, overwrites: dict, category: discord.CategoryChannel, challenge=True):
-    if len(category.channels) == CATEGORY_MAX_CHANNELS:
-        category = await get_backup_category(category)
+    category = await _get_category_with_room(category)
 
     if challenge:
         pos = get_category_pos(category, name)
-        return await category.create_text_channel(name, overwrites=overwrites, position=pos)
+        new_channel = await category.create_text_channel(name, overwrites=overwrites, position=pos)
     else:
-        return await category.create_text_channel(name, overwrites=overwrites)
+        new_channel = await category.create_text_channel(name, overwrites=overwrites)
+    track_channel(new_channel)
+    return new_channel
 
 
 async def move_channel(channel: discord.TextChannel, goal_category: discord.CategoryChannel, challenge=True):
     if goal_category == channel.category:
         return
-    if len(goal_category.channels) == CATEGORY_MAX_CHANNELS:
-        goal_category = await get_backup_category(goal_category)
+    goal_category = await _get_category_with_room(goal_category)
 
     original_category = channel.category
 
     if challenge:
         pos = get_category_pos(goal_category, channel.name)
-        await channel.edit(category=goal_category, position=pos)
+        new_channel = await channel.edit(category=goal_category, position=pos)
     else:
-        await channel.edit(category=goal_category)
-
-    await free_backup_category(original_category)
+        new_channel = await channel.edit(category=goal_category)
+    track_channel(new_channel or channel)
+
+    if original_category is not None:
+        await free_backup_category(original_category)
+
+
+async def _plan_category_slots(goal_category: discord.CategoryChannel, count: int) -> list[discord.CategoryChannel]:
+    """Returns a target category for each of count channels, filling goal_category and then its
+    backup categories, and creating new backup categories if needed"""
+    if goal_category.id in _provisioning:
+        await asyncio.shield(_provisioning[goal_category.id])
+    slots = []
+    for category_id in category_capacity.chain(goal_category.id):
+        category = goal_category.guild.get_channel(category_id)
+        if category is not None and len(slots) < count:
+            slots += [category] * max(0, min(CATEGORY_MAX_CHANNELS - category_capacity.count(category_id), count - len(slots)))
+    while len(slots) < count:
+        category = await _create_backup_category(goal_category, category_capacity.next_index(goal_category.id))
+        slots += [category] * min(CATEGORY_MAX_CHANNELS, count - len(slots))
+    return slots
+
+
+async def move_channels(moves: list[tuple[discord.TextChannel, discord.CategoryChannel]],
+                        progress: Callable[[int, int], Awaitable[None]] | None = None):
+    """Move many challenge channels at once. All target categories are planned first, and the moves are
+    then applied with the bulk channel position endpoint instead of one edit per channel."""
+    moves = [(channel, goal) for channel, goal in moves if channel.category != goal]
+    if not moves:
+        return
+    guild = moves[0][0].guild
+
+    by_goal: dict[discord.CategoryChannel, list[discord.TextChannel]] = {}
+    for channel, goal_category in moves:
+        by_goal.setdefault(goal_category, []).append(channel)
+
+    payload = []
+    for goal_category, channels in by_goal.items():
+        channels.sort(key=lambda c: (_split_challenge_name(c.name) or ('', ''), c.name))
+        slots = await _plan_category_slots(goal_category, len(channels))
+        positions = {}
+        for channel, category in zip(channels, slots):
+            if category not in positions:
+                positions[category] = get_category_pos(category, channel.name)
+            payload.append({'id': channel.id, 'parent_id': category.id, 'position': positions[category], 'lock_permissions': False})
+            positions[category] += 1
+
+    sources = {channel.category for channel, _ in moves if channel.category is not None}
+
+    # discord.py has no public wrapper for moving several channels in one request
+    for i in range(0, len(payload), CATEGORY_MAX_CHANNELS):
+        chunk = payload[i:i + CATEGORY_MAX_CHANNELS]
+        await guild._state.http.bulk_channel_update(guild.id, chunk, reason="Moving CTF channels")
+        for move in chunk:
+            category_capacity.place(move['id'], move['parent_id'])
+        if progress:
+            await progress(min(i + CATEGORY_MAX_CHANNELS, len(payload)), len(payload))
+
+    for category in sources:
+        await free_backup_category(category)
+    for goal_category in by_goal:
+        _provision_backup_category(goal_category)
 
 
 async def is_team_admin(interaction: discord.Interaction) -> bool:
-    if not get_admin_role(interaction.guild) in interaction.user.roles:
+    if not await get_admin_role(interaction.guild) in interaction.user.roles:
         raise app_commands.AppCommandError("Only team admins are allowed to run this command")
     return True
 
@@ -135,7 +351,7 @@ def _discord_create(guild: discord.Guild, name: str, id_type: str):
     return None
 
 async def setup_settings(guild: discord.Guild):
-    settings = GuildSettings.objects(guild_id=guild.id).first()
+    settings = await repository.get_guild_settings(guild.id)
     if settings is None:
         settings = GuildSettings(guild_id=guild.id)
 
@@ -161,7 +377,7 @@ async def setup_settings(guild: discord.Guild):
             continue
         new_id = (await _discord_create(guild, name, key_type)).id
         setattr(settings, key, new_id)
-    settings.save()
+    await repository.save_settings(settings)
 
     # Add guild admins to admin and team roles
     try:
@@ -172,37 +388,37 @@ async def setup_settings(guild: discord.Guild):
         # The roles already existed before the bot, so the bot doesn't have access to modify them
         pass
 
-def get_settings(guild: discord.Guild) -> GuildSettings:
+async def get_settings(guild: discord.Guild) -> GuildSettings:
     if guild is None:
         raise app_commands.AppCommandError("You must run this command in a guild")
-    settings = GuildSettings.objects(guild_id=guild.id).first()
+    settings = await repository.get_guild_settings(guild.id)
     if settings is None:
         raise app_commands.AppCommandError("Settings have not been set up correctly for this guild. "
                                            "Please remove and re-invite the bot to fix this.")
     return settings
 
 
-def get_admin_role(guild: discord.Guild, settings: GuildSettings | None = None) -> discord.Role:
+async def get_admin_role(guild: discord.Guild, settings: GuildSettings | None = None) -> discord.Role:
     if settings is None:
-        settings = get_settings(guild)
+        settings = await get_settings(guild)
     admin_role = guild.get_role(settings.admin_role)
     if admin_role is None:
         raise app_commands.AppCommandError("Admin role missing. Please re-invite the bot to fix this.")
     return admin_role
 
 
-def get_team_role(guild: discord.Guild, settings: GuildSettings | None = None) -> discord.Role:
+async def get_team_role(guild: discord.Guild, settings: GuildSettings | None = None) -> discord.Role:
     if settings is None:
-        settings = get_settings(guild)
+        settings = await get_settings(guild)
     team_role = guild.get_role(settings.team_role)
     if team_role is None:
         raise app_commands.AppCommandError("Team role missing. Fix this with /psybot set team_role <role_id>")
     return team_role
 
 
-def get_inactive_role(guild: discord.Guild, settings: GuildSettings | None = None) -> discord.Role:
+async def get_inactive_role(guild: discord.Guild, settings: GuildSettings | None = None) -> discord.Role:
     if settings is None:
-        settings = get_settings(guild)
+        settings = await get_settings(guild)
     inactive_role = guild.get_role(settings.inactive_role)
     if inactive_role is None:
         raise app_commands.AppCommandError("Inactive role missing. Fix this with /psybot set inactive_role <role_id>")
@@ -210,26 +426,26 @@ def get_inactive_role(guild: discord.Guild, settings: GuildSettings | None = Non
 
 
 
-def get_export_channel(guild: discord.Guild, settings: GuildSettings | None = None) -> discord.TextChannel:
+async def get_export_channel(guild: discord.Guild, settings: GuildSettings | None = None) -> discord.TextChannel:
     if settings is None:
-        settings = get_settings(guild)
+        settings = await get_settings(guild)
     export_channel = guild.get_channel(settings.export_channel)
     if export_channel is None:
         raise app_commands.AppCommandError("Export channel missing. Fix this with /psybot set export_channel <channel_id>")
     return export_channel
 
 
-def _get_category(guild: discord.Guild, category_name: str, settings: GuildSettings | None = None) -> discord.CategoryChannel:
+async def _get_category(guild: discord.Guild, category_name: str, settings: GuildSettings | None = None) -> discord.CategoryChannel:
     if settings is None:
-        settings = get_settings(guild)
+        settings = await get_settings(guild)
     category = guild.get_channel(getattr(settings, category_name))
     if not isinstance(category, discord.CategoryChannel):
         raise app_commands.AppCommandError("'{0}' category missing. Fix this with /psybot set {0} <category_id>".format(category_name))
     return category
 
-get_ctfs_category = lambda g, settings=None: _get_category(g, 'ctfs_category')
-get_incomplete_category = lambda g, settings=None: _get_category(g, 'incomplete_category')
-get_complete_category = lambda g, settings=None: _get_category(g, 'complete_category')
-get_archive_category = lambda g, settings=None: _get_category(g, 'archive_category')
-get_ctf_archive_category = lambda g, settings=None: _get_category(g, 'ctf_archive_category')
-get_voice_category = lambda g, settings=None: _get_category(g, 'voice_category')
+get_ctfs_category = lambda g, settings=None: _get_category(g, 'ctfs_category', settings)
+get_incomplete_category = lambda g, settings=None: _get_category(g, 'incomplete_category', settings)
+get_complete_category = lambda g, settings=None: _get_category(g, 'complete_category', settings)
+get_archive_category = lambda g, settings=None: _get_category(g, 'archive_category', settings)
+get_ctf_archive_category = lambda g, settings=None: _get_category(g, 'ctf_archive_category', settings)
+get_voice_category = lambda g, settings=None: _get_category(g, 'voice_category', settings)
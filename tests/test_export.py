@@ -0,0 +1,43 @@
+import io
+import json
+import os
+
+os.environ.setdefault("BOT_TOKEN", "test")
+
+from psybot.modules.export import _merge_part, resolve_records  # noqa: E402
+
+
+def write_part(path, records):
+    path.write_text("".join(json.dumps(record) + "\n" for record in records))
+    return path
+
+
+def message(message_id, content):
+    return {"type": "message", "channel": 1, "id": message_id, "content": content, "author": 1, "mentions": [1],
+            "embeds": []}
+
+
+def test_incremental_merge_uses_latest_user(tmp_path):
+    channel = {"type": "channel", "id": 1, "name": "ctf"}
+    old_part = write_part(tmp_path / "old.jsonl", [
+        channel,
+        {"type": "user", "id": 1, "nick": "old"},
+        message(100, "first"),
+        message(101, "second"),
+    ])
+    new_part = write_part(tmp_path / "new.jsonl", [
+        channel,
+        {"type": "user", "id": 1, "nick": "new"},
+        message(101, "second (edited)"),
+        message(102, "third"),
+    ])
+
+    out = io.StringIO()
+    _merge_part(out, old_part, new_part, 101)
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    messages = [record for record in resolve_records(records) if record["type"] == "message"]
+
+    assert [m["id"] for m in messages] == [100, 101, 102]
+    assert messages[1]["content"] == "second (edited)"
+    assert all(m["author"]["nick"] == "new" for m in messages)
+    assert all(m["mentions"][0]["nick"] == "new" for m in messages)